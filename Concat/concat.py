@@ -5,22 +5,35 @@ import argparse
 import glob
 import json
 import time
+import re
 import shutil
+import threading
+import signal
+import hashlib
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from PIL import Image
 
 DEBUG = False
+_active_processes = set()
+_process_lock = threading.Lock()
 
 def debug_print(*args, **kwargs):
     if DEBUG:
         print(*args, **kwargs)
 
-def run_command(command, suppress_errors=False, timeout=None, retries=1):
+def run_command(command, suppress_errors=False, timeout=None, retries=1, cancel_event=None):
+    # A set cancel_event is checked under the lock terminate_active_processes takes, so no ffmpeg starts after a cancel
     attempt = 0
     while attempt <= retries:
         debug_print(f"Running command (Attempt {attempt+1}/{retries+1}): {command}")
         stdout = subprocess.PIPE if not suppress_errors else subprocess.DEVNULL
         stderr = subprocess.PIPE if not suppress_errors else subprocess.DEVNULL
-        process = subprocess.Popen(command, shell=True, stdout=stdout, stderr=stderr, text=True)
+        with _process_lock:
+            if cancel_event is not None and cancel_event.is_set():
+                return False, "Cancelled"
+            process = subprocess.Popen(command, shell=True, stdout=stdout, stderr=stderr, text=True, start_new_session=(os.name != "nt"))
+            _active_processes.add(process)
         output, errors = [], []
         try:
             stdout_data, stderr_data = process.communicate(timeout=timeout)
@@ -40,7 +53,7 @@ def run_command(command, suppress_errors=False, timeout=None, retries=1):
                 return False, output_str + "\n" + error_str
             return True, output_str
         except subprocess.TimeoutExpired:
-            process.kill()
+            kill_process_tree(process)
             attempt += 1
             if attempt <= retries:
                 debug_print(f"Timeout after {timeout}s. Retrying {attempt}/{retries}")
@@ -49,43 +62,795 @@ def run_command(command, suppress_errors=False, timeout=None, retries=1):
             debug_print(f"Timeout after {timeout}s. No more retries")
             return False, f"Timeout after {timeout}s"
         except Exception as ex:
-            process.kill()
+            kill_process_tree(process)
             debug_print(f"Error: {ex}")
             return False, str(ex)
         finally:
+            # Also reached on Ctrl-C: ffmpeg runs in its own process group and would not see the signal
             if process.poll() is None:
-                process.terminate()
+                kill_process_tree(process)
+            with _process_lock:
+                _active_processes.discard(process)
+
+def kill_process_tree(process):
+    # shell=True puts ffmpeg under a shell, so kill the whole group rather than just the shell
+    if os.name == "nt":
+        subprocess.run(f"taskkill /F /T /PID {process.pid}", shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    else:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+def terminate_active_processes():
+    # Stops every ffmpeg still running so nothing writes into temp/ after it is removed
+    with _process_lock:
+        processes = list(_active_processes)
+    for process in processes:
+        if process.poll() is None:
+            kill_process_tree(process)
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            pass
+
+_used_numbers = {}
 
 def get_next_available_name(output_dir, prefix, extension, start_number=1):
+    # Lists output_dir once per prefix/extension, then reserves each name with an exclusive create
+    # so concurrent runs writing to the same folder never pick the same file
+    key = (os.path.abspath(output_dir), prefix, extension)
+    if key not in _used_numbers:
+        pattern = re.compile(rf"{re.escape(prefix)}_(\d+){re.escape(extension)}")
+        used = set()
+        try:
+            with os.scandir(output_dir) as it:
+                for entry in it:
+                    match = pattern.fullmatch(entry.name)
+                    if match:
+                        used.add(int(match.group(1)))
+        except FileNotFoundError:
+            pass
+        _used_numbers[key] = used
+    used = _used_numbers[key]
     number = start_number
     while True:
+        while number in used:
+            number += 1
+        used.add(number)
         name = f"{prefix}_{number}{extension}"
         full_path = os.path.join(output_dir, name)
-        if not os.path.exists(full_path):
-            return name, full_path, number + 1
-        number += 1
+        try:
+            os.close(os.open(full_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+        except FileExistsError:
+            continue
+        return name, full_path, number + 1
 
-def has_audio_stream(file_path):
-    command = f'ffprobe -v error -show_streams -select_streams a -of default=noprint_wrappers=1 "{file_path}"'
-    debug_print(f"Checking audio: {command}")
-    success, output = run_command(command)
-    return bool(output.strip())
+def release_name(full_path):
+    # Remove the empty placeholder left by get_next_available_name when nothing was written
+    try:
+        if os.path.getsize(full_path) == 0:
+            os.remove(full_path)
+    except OSError:
+        pass
 
-def get_video_dimensions(file_path):
-    command = f'ffprobe -v error -select_streams v:0 -show_entries stream=width,height -of json "{file_path}"'
+_probe_cache = {}
+_probe_lock = threading.Lock()
+
+def probe_file(file_path):
+    # One ffprobe per file per run: streams, duration and dimensions, memoized by path, size and mtime
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        stat = None
+    key = (os.path.abspath(file_path), stat.st_size if stat else None, stat.st_mtime_ns if stat else None)
+    with _probe_lock:
+        if key in _probe_cache:
+            return _probe_cache[key]
+    command = (
+        f'ffprobe -v error -show_entries '
+        f'stream=codec_type,codec_name,profile,width,height,pix_fmt,r_frame_rate,time_base,sample_rate,channels'
+        f':format=duration -of json "{file_path}"'
+    )
+    debug_print(f"Probing: {command}")
     success, output = run_command(command)
+    streams, duration = [], 0.0
     if success:
         try:
             data = json.loads(output)
-            if data.get('streams'):
-                return data['streams'][0]['width'], data['streams'][0]['height']
-        except json.JSONDecodeError:
-            pass
+            streams = data.get('streams', [])
+            duration = float(data.get('format', {}).get('duration') or 0)
+        except (json.JSONDecodeError, ValueError):
+            debug_print(f"Could not parse ffprobe output for {file_path}: {output}")
+    video = next((stream for stream in streams if stream.get('codec_type') == 'video'), None)
+    info = {
+        "ok": success and bool(streams),
+        "streams": streams,
+        "duration": duration,
+        "width": video.get('width') if video else None,
+        "height": video.get('height') if video else None,
+        "has_audio": any(stream.get('codec_type') == 'audio' for stream in streams),
+    }
+    with _probe_lock:
+        _probe_cache[key] = info
+    return info
+
+def has_audio_stream(file_path):
+    return probe_file(file_path)["has_audio"]
+
+def get_video_dimensions(file_path):
+    info = probe_file(file_path)
+    if info["width"] and info["height"]:
+        return info["width"], info["height"]
     print(f"Warning: Could not get dimensions for {file_path}. Using 1920x1080")
     return 1920, 1080
 
+DEFAULT_RATE_FLAGS = "-b:v 5000k"
+
+def get_normalize_command(file_path, output_target, video_filter_string, ffmpeg_preset, threads=None, rate_flags=DEFAULT_RATE_FLAGS, audio_filter=""):
+    # output_target is everything after the encode settings: a quoted path, or format flags and a pipe
+    threads_flag = f"-threads {threads} " if threads else ""
+    if has_audio_stream(file_path):
+        audio_filter_flag = f'-af "{audio_filter}" ' if audio_filter else ""
+        return (
+            f'ffmpeg -y -i "{file_path}" '
+            f'-c:v libx264 -preset {ffmpeg_preset} {rate_flags} -r 30 -pix_fmt yuv420p {threads_flag}'
+            f'-force_key_frames "expr:gte(t,n_forced*2)" '
+            f'-c:a aac -b:a 192k -ar 48000 -ac 2 {audio_filter_flag}'
+            f'-vf "{video_filter_string}" '
+            f'{output_target}'
+        )
+    return (
+        f'ffmpeg -y -i "{file_path}" '
+        f'-f lavfi -i anullsrc=channel_layout=stereo:sample_rate=48000 '
+        f'-c:v libx264 -preset {ffmpeg_preset} {rate_flags} -r 30 -pix_fmt yuv420p {threads_flag}'
+        f'-force_key_frames "expr:gte(t,n_forced*2)" '
+        f'-c:a aac -b:a 192k -ar 48000 -ac 2 -shortest '
+        f'-vf "{video_filter_string}" '
+        f'{output_target}'
+    )
+
+def normalize_segment(file_path, temp_output_path, video_filter_string, ffmpeg_preset, threads=None, cancel_event=None, rate_flags=DEFAULT_RATE_FLAGS, audio_filter=""):
+    if cancel_event is not None and cancel_event.is_set():
+        return False, "Cancelled"
+    ffmpeg_command = get_normalize_command(file_path, f'"{temp_output_path}"', video_filter_string, ffmpeg_preset, threads, rate_flags, audio_filter)
+    debug_print(f"FFmpeg command for {os.path.basename(file_path)}: {ffmpeg_command}")
+    success, output = run_command(ffmpeg_command, timeout=300, retries=1, cancel_event=cancel_event)
+    if cancel_event is not None and cancel_event.is_set():
+        return False, "Cancelled"
+    return success and os.path.exists(temp_output_path), output
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+def start_stream_process(command, stdin=None, stdout=None):
+    process = subprocess.Popen(
+        command, shell=True, stdin=stdin, stdout=stdout, stderr=None if DEBUG else subprocess.DEVNULL, start_new_session=(os.name != "nt"),
+    )
+    with _process_lock:
+        _active_processes.add(process)
+    return process
+
+def read_stream_segment(process, chunks):
+    # Reads ahead of the muxer until the queue is full; a blocked put stops reading the pipe,
+    # so the normalizer itself stalls instead of growing memory
+    for chunk in iter(lambda: process.stdout.read(STREAM_CHUNK_SIZE), b''):
+        chunks.put(chunk)
+    chunks.put(None)
+
+def concat_streaming(input_files, final_output_path, video_filter_string, ffmpeg_preset, jobs, threads, buffer_mb, encode_settings=None, container_flags="", audio_filters=None, timings=None, sizes=None):
+    # Normalizers write MPEG-TS to stdout and one muxer reads them back to back from its stdin.
+    # Each segment is shifted by the duration of everything before it so timestamps keep increasing.
+    # timings and sizes, if given, receive seconds from start to exit and MPEG-TS bytes per input
+    offsets = []
+    offset = 0.0
+    for file_path in input_files:
+        offsets.append(offset)
+        offset += probe_file(file_path)["duration"]
+
+    muxer_command = f'ffmpeg -y -f mpegts -i pipe:0 -map 0 -c copy -bsf:a aac_adtstoasc {container_flags}"{final_output_path}"'
+    debug_print(f"FFmpeg muxer command: {muxer_command}")
+    muxer = start_stream_process(muxer_command, stdin=subprocess.PIPE)
+    buffer_chunks = max(1, int(buffer_mb * 1024 * 1024 // STREAM_CHUNK_SIZE))
+    started = []
+
+    def start_segment(index):
+        preset, rate_flags = (encode_settings or {}).get(input_files[index], (ffmpeg_preset, DEFAULT_RATE_FLAGS))
+        command = get_normalize_command(
+            input_files[index], f'-f mpegts -output_ts_offset {offsets[index]:.3f} pipe:1',
+            video_filter_string, preset, threads, rate_flags, (audio_filters or {}).get(input_files[index], ""),
+        )
+        debug_print(f"FFmpeg command for {os.path.basename(input_files[index])}: {command}")
+        process = start_stream_process(command, stdout=subprocess.PIPE)
+        chunks = queue.Queue(maxsize=buffer_chunks)
+        threading.Thread(target=read_stream_segment, args=(process, chunks), daemon=True).start()
+        started.append((process, chunks, time.time()))
+
+    try:
+        for index, file_path in enumerate(input_files):
+            # Up to `jobs` normalizers run at once; the ones ahead of the muxer fill their buffers and wait
+            while len(started) < min(len(input_files), index + jobs):
+                start_segment(len(started))
+            process, chunks, start_time = started[index]
+            streamed = 0
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    break
+                muxer.stdin.write(chunk)
+                streamed += len(chunk)
+            if process.wait() != 0:
+                return False, f"Failed to process {file_path} into stream (exit code {process.returncode})"
+            if timings is not None:
+                timings[file_path] = time.time() - start_time
+            if sizes is not None:
+                sizes[file_path] = streamed
+            print(f"Streamed {os.path.basename(file_path)}")
+        muxer.stdin.close()
+        if muxer.wait() != 0:
+            return False, f"Muxer failed (exit code {muxer.returncode})"
+        return True, ""
+    except (BrokenPipeError, OSError) as e:
+        return False, f"Muxer stopped reading: {e}"
+    finally:
+        terminate_active_processes()
+        with _process_lock:
+            _active_processes.difference_update([muxer] + [process for process, _, _ in started])
+
+SEGMENT_CACHE_VERSION = "1"
+FINGERPRINT_SAMPLE_SIZE = 64 * 1024
+
+def get_file_hash(file_path, sample_size=FINGERPRINT_SAMPLE_SIZE):
+    # Hash of size plus head/middle/tail samples; small files are hashed in full
+    try:
+        size = os.path.getsize(file_path)
+        hash_obj = hashlib.blake2b(digest_size=16)
+        hash_obj.update(str(size).encode())
+        with open(file_path, 'rb') as f:
+            if size <= sample_size * 3:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    hash_obj.update(chunk)
+            else:
+                for offset in (0, (size - sample_size) // 2, size - sample_size):
+                    f.seek(offset)
+                    hash_obj.update(f.read(sample_size))
+        return hash_obj.hexdigest()
+    except OSError as e:
+        debug_print(f"Could not hash {file_path}: {e}")
+        return None
+
+def get_cache_settings(preset, rate_flags, audio_filter=""):
+    # Encode settings that change a segment's bytes; the defaults keep the keys of older cache entries
+    settings = preset if rate_flags == DEFAULT_RATE_FLAGS else f"{preset} {rate_flags}"
+    return f"{settings} {audio_filter}" if audio_filter else settings
+
+def get_segment_cache_path(cache_dir, file_path, resolution, ffmpeg_preset, video_filter_string):
+    fingerprint = get_file_hash(file_path)
+    if not fingerprint:
+        return None
+    key = hashlib.blake2b(
+        "|".join([SEGMENT_CACHE_VERSION, fingerprint, resolution, ffmpeg_preset, video_filter_string]).encode(),
+        digest_size=16,
+    ).hexdigest()
+    return os.path.join(cache_dir, f"{key}.mp4")
+
+STALE_PARTIAL_SECONDS = 3600
+
+def prune_segment_cache(cache_dir, max_bytes, keep=()):
+    # Least recently used first; entries used by this run are never evicted.
+    # Partials still being written by another run count toward the size; ones not touched for an hour were left by an interrupted run
+    entries = []
+    partial_bytes = 0
+    now = time.time()
+    for entry in os.scandir(cache_dir):
+        if not entry.is_file() or not entry.name.endswith(".mp4"):
+            continue
+        stat = entry.stat()
+        if ".partial" not in entry.name:
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        elif now - stat.st_mtime > STALE_PARTIAL_SECONDS:
+            try:
+                os.remove(entry.path)
+                debug_print(f"Removed stale partial segment: {entry.path}")
+            except OSError:
+                pass
+        else:
+            partial_bytes += stat.st_size
+    total = partial_bytes + sum(size for _, size, _ in entries)
+    keep = set(keep)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path in keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+            debug_print(f"Evicted cached segment: {path}")
+        except OSError:
+            pass
+    debug_print(f"Segment cache size: {total / 1048576:.1f} MB")
+
+def get_segment_params(file_path):
+    # Stream parameters that must be identical for the concat demuxer to join files with -c copy
+    info = probe_file(file_path)
+    if not info["ok"]:
+        return None
+    return tuple(sorted(tuple(sorted(stream.items())) for stream in info["streams"]))
+
+def segments_match(processed_videos, presets=None):
+    # Probed fields do not show x264 settings such as reference frames or weighted prediction, which live in
+    # the SPS/PPS; segments from different presets must not share one avcC, so the preset is part of the key.
+    # Bitrate alone does not change the headers (x264 uses a fixed initial QP in bitrate mode)
+    params = [get_segment_params(video) for video in processed_videos]
+    if any(p is None for p in params):
+        debug_print("Could not probe every segment, using concat filter")
+        return False
+    if presets and len(set(presets)) != 1:
+        debug_print(f"Segments were encoded with different presets, using concat filter: {set(presets)}")
+        return False
+    if len(set(params)) != 1:
+        debug_print(f"Segment parameters differ, using concat filter: {set(params)}")
+        return False
+    return True
+
+APPEND_PARAM_KEYS = ("codec_type", "codec_name", "profile", "width", "height", "pix_fmt", "r_frame_rate", "sample_rate", "channels")
+
+def get_append_params(file_path):
+    # Looser than get_segment_params: a muxed output can report a different time base
+    # than its segments while still accepting them with -c copy
+    info = probe_file(file_path)
+    if not info["ok"]:
+        return None
+    return tuple(sorted(tuple(stream.get(key) for key in APPEND_PARAM_KEYS) for stream in info["streams"]))
+
+def get_output_encode(segment_settings):
+    # Preset and rate flags shared by every segment of an output, None where they differ
+    presets = {preset for preset, _ in segment_settings}
+    rates = {rate_flags for _, rate_flags in segment_settings}
+    return {
+        "preset": presets.pop() if len(presets) == 1 else None,
+        "rate": rates.pop() if len(rates) == 1 else None,
+    }
+
+def can_append(existing_output, segments, output_encode, segment_encode):
+    # The MP4 keeps only the first file's SPS/PPS, so the encoder settings must match as well as the probed streams;
+    # outputs from before the settings were recorded are always rebuilt
+    if not output_encode or output_encode != segment_encode:
+        debug_print(f"Encode settings of {existing_output} ({output_encode}) differ from the new segments ({segment_encode}), cannot append")
+        return False
+    existing_params = get_append_params(existing_output)
+    if existing_params is None:
+        debug_print(f"Could not probe {existing_output}, cannot append")
+        return False
+    for segment in segments:
+        params = get_append_params(segment)
+        if params != existing_params:
+            debug_print(f"Segment {segment} does not match {existing_output}: {params} != {existing_params}")
+            return False
+    return True
+
+OUTPUT_EXTENSIONS = {"mp4": ".mp4", "fmp4": ".mp4", "hls": ".m3u8"}
+HLS_SEGMENT_SECONDS = 6
+
+def get_container_flags(output_format, final_output_path):
+    # Muxer options for the final stage, so packaging needs no separate rewrite of the finished file
+    if output_format == "fmp4":
+        # moov is written first and media follows in fragments, so playback can start while the file is still arriving
+        return "-movflags +frag_keyframe+empty_moov+default_base_moof "
+    if output_format == "hls":
+        # CMAF style: fMP4 media segments on the 2 s keyframe grid plus an init segment and a VOD playlist
+        base = os.path.splitext(final_output_path)[0]
+        return (
+            f'-f hls -hls_time {HLS_SEGMENT_SECONDS} -hls_playlist_type vod -hls_segment_type fmp4 '
+            f'-hls_fmp4_init_filename "{os.path.basename(base)}_init.mp4" -hls_segment_filename "{base}_%05d.m4s" '
+        )
+    return ""
+
+def concat_with_demuxer(processed_videos, final_output_path, temp_dir, container_flags=""):
+    list_path = os.path.join(temp_dir, "concat_list.txt")
+    with open(list_path, "w") as f:
+        for video in processed_videos:
+            escaped = video.replace(os.sep, '/').replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+    ffmpeg_command = f'ffmpeg -y -f concat -safe 0 -i "{list_path}" -map 0 -c copy {container_flags}"{final_output_path}"'
+    debug_print(f"FFmpeg concat command: {ffmpeg_command}")
+    return run_command(ffmpeg_command, timeout=600, retries=1)
+
+def concat_with_filter(processed_videos, final_output_path, ffmpeg_preset, container_flags=""):
+    input_string = " ".join([f"-i \"{v}\"" for v in processed_videos])
+    audio_flags = [has_audio_stream(video) for video in processed_videos]
+    any_audio = any(audio_flags)
+    filter_inputs = []
+    for i, has_audio in enumerate(audio_flags):
+        filter_inputs.append(f"[{i}:v]")
+        if has_audio:
+            filter_inputs.append(f"[{i}:a]")
+
+    concat_filter = f"{' '.join(filter_inputs)}concat=n={len(processed_videos)}:v=1:a={1 if any_audio else 0}[outv]{'[outa]' if any_audio else ''}"
+    map_string = "-map [outv]" + (" -map [outa]" if any_audio else " -an")
+    ffmpeg_command = (
+        f'ffmpeg -y {input_string} '
+        f'-filter_complex "{concat_filter}" '
+        f'{map_string} '
+        f'-c:v libx264 -preset {ffmpeg_preset} -b:v 5000k -r 30 -pix_fmt yuv420p '
+        f'{"-c:a aac -b:a 192k -ar 48000 -ac 2" if any_audio else "-an"} '
+        f'{container_flags}"{final_output_path}"'
+    )
+    debug_print(f"FFmpeg concat command: {ffmpeg_command}")
+    return run_command(ffmpeg_command, timeout=600, retries=1)
+
+# Encode time of each x264 preset relative to the preset used for sample encodes
+PRESET_COST = {
+    "ultrafast": 0.4, "superfast": 0.6, "veryfast": 1.0, "faster": 1.6, "fast": 2.0,
+    "medium": 2.6, "slow": 4.0, "slower": 7.0, "veryslow": 14.0,
+}
+SAMPLE_PRESET = "veryfast"
+SAMPLE_CRF = 23
+SAMPLE_SECONDS = 5
+AUDIO_BITRATE_KBPS = 192
+MIN_VIDEO_BITRATE_KBPS = 300
+
+def parse_duration(value):
+    # "90", "90s", "10m" or "1.5h" in seconds
+    match = re.fullmatch(r"\s*([\d.]+)\s*([smh]?)\s*", value.lower())
+    if not match:
+        raise argparse.ArgumentTypeError(f"Invalid duration '{value}', use e.g. 90s, 10m or 1h")
+    return float(match.group(1)) * {"": 1, "s": 1, "m": 60, "h": 3600}[match.group(2)]
+
+def parse_size(value):
+    # "200MB", "1.5GB" or "500KB" in bytes; a bare number is MB
+    match = re.fullmatch(r"\s*([\d.]+)\s*([kmg]?)b?\s*", value.lower())
+    if not match:
+        raise argparse.ArgumentTypeError(f"Invalid size '{value}', use e.g. 200MB or 1.5GB")
+    return int(float(match.group(1)) * {"k": 1024, "": 1024 ** 2, "m": 1024 ** 2, "g": 1024 ** 3}[match.group(2)])
+
+def sample_encode(file_path, temp_dir, video_filter_string, threads=None):
+    # Encodes a few seconds from the middle of the input at a fixed preset and CRF:
+    # the time taken gives the encode speed, the output size gives how complex the content is
+    duration = probe_file(file_path)["duration"]
+    sample_seconds = min(SAMPLE_SECONDS, duration) if duration else SAMPLE_SECONDS
+    start = max(0.0, duration / 2 - sample_seconds / 2)
+    sample_path = os.path.join(temp_dir, f"sample_{hashlib.blake2b(file_path.encode(), digest_size=8).hexdigest()}.mp4")
+    threads_flag = f"-threads {threads} " if threads else ""
+    ffmpeg_command = (
+        f'ffmpeg -y -ss {start:.3f} -t {sample_seconds:.3f} -i "{file_path}" '
+        f'-c:v libx264 -preset {SAMPLE_PRESET} -crf {SAMPLE_CRF} -r 30 -pix_fmt yuv420p {threads_flag}'
+        f'-vf "{video_filter_string}" -an "{sample_path}"'
+    )
+    debug_print(f"Sample encode for {os.path.basename(file_path)}: {ffmpeg_command}")
+    start_time = time.time()
+    success, output = run_command(ffmpeg_command, timeout=120, retries=0)
+    elapsed = max(time.time() - start_time, 0.001)
+    try:
+        size = os.path.getsize(sample_path) if success else 0
+        if os.path.exists(sample_path):
+            os.remove(sample_path)
+    except OSError:
+        size = 0
+    if not success or not size:
+        debug_print(f"Sample encode failed for {file_path}: {output}")
+        return None
+    return {"seconds_per_second": elapsed / sample_seconds, "kbps": size * 8 / 1000 / sample_seconds}
+
+def plan_encode_budget(input_files, temp_dir, video_filter_string, ffmpeg_preset, jobs, threads, time_budget=None, size_target=None):
+    # Picks a preset and rate flags per input so the normalize stage fits the time budget and/or output size.
+    # Every input gets the fastest of the per-input presets: segments with mixed presets cannot be joined by
+    # stream copy, and the re-encode of the whole compilation that would follow is outside the budget.
+    # Returns {input: (preset, rate flags)} and {input: (predicted seconds, predicted bytes)}
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        samples = dict(zip(input_files, pool.map(lambda f: sample_encode(f, temp_dir, video_filter_string, threads), input_files)))
+    durations = {f: probe_file(f)["duration"] or SAMPLE_SECONDS for f in input_files}
+    measured = [sample for sample in samples.values() if sample]
+    # Inputs whose sample failed are treated like an average input
+    fallback = {
+        "seconds_per_second": sum(s["seconds_per_second"] for s in measured) / len(measured) if measured else 1.0,
+        "kbps": sum(s["kbps"] for s in measured) / len(measured) if measured else 5000.0,
+    }
+    samples = {f: sample or fallback for f, sample in samples.items()}
+    total_duration = sum(durations.values())
+
+    rates = {f: DEFAULT_RATE_FLAGS for f in input_files}
+    video_kbps = {f: 5000.0 for f in input_files}
+    if size_target:
+        # Split the video bits by duration times sample bitrate, so busy inputs get more of the target
+        video_bits = size_target * 8 - AUDIO_BITRATE_KBPS * 1000 * total_duration
+        weights = {f: durations[f] * samples[f]["kbps"] for f in input_files}
+        total_weight = sum(weights.values()) or 1.0
+        for f in input_files:
+            kbps = max(MIN_VIDEO_BITRATE_KBPS, video_bits * weights[f] / total_weight / durations[f] / 1000)
+            video_kbps[f] = kbps
+            rates[f] = f"-b:v {int(kbps)}k -maxrate {int(kbps * 1.5)}k -bufsize {int(kbps * 2)}k"
+        if video_bits / 1000 / total_duration < MIN_VIDEO_BITRATE_KBPS:
+            print(f"Warning: {size_target / 1048576:.0f} MB is too small for {total_duration:.0f}s of video, using the {MIN_VIDEO_BITRATE_KBPS}k minimum")
+
+    ladder = sorted(PRESET_COST, key=PRESET_COST.get)
+    presets = {f: ffmpeg_preset for f in input_files}
+    if time_budget:
+        # Each input gets a share of the budget by duration; with --jobs N, N inputs encode at once
+        for f in input_files:
+            share = time_budget * jobs * durations[f] / total_duration
+            base = samples[f]["seconds_per_second"] * durations[f] / PRESET_COST[SAMPLE_PRESET]
+            fitting = [p for p in ladder if base * PRESET_COST[p] <= share and PRESET_COST[p] <= PRESET_COST[ffmpeg_preset]]
+            presets[f] = fitting[-1] if fitting else ladder[0]
+        if presets:
+            fastest = min(presets.values(), key=PRESET_COST.get)
+            presets = {f: fastest for f in input_files}
+
+    settings = {}
+    predictions = {}
+    for f in input_files:
+        settings[f] = (presets[f], rates[f])
+        predicted_seconds = samples[f]["seconds_per_second"] * durations[f] * PRESET_COST[presets[f]] / PRESET_COST[SAMPLE_PRESET]
+        predicted_bytes = (video_kbps[f] + AUDIO_BITRATE_KBPS) * 1000 * durations[f] / 8
+        predictions[f] = (predicted_seconds, predicted_bytes)
+    return settings, predictions
+
+def report_encode_budget(input_files, settings, predictions, timings, sizes, jobs):
+    # timings and sizes hold the measured encode seconds and output bytes per input
+    print("Encode budget report:")
+    total_predicted = total_actual = 0.0
+    total_predicted_bytes = total_actual_bytes = 0
+    for file_path in input_files:
+        preset, rate_flags = settings[file_path]
+        predicted_seconds, predicted_bytes = predictions[file_path]
+        actual_seconds = timings.get(file_path)
+        actual_bytes = sizes.get(file_path, 0)
+        actual_text = f"{actual_seconds:.1f}s" if actual_seconds is not None else "cached"
+        print(
+            f"  {os.path.basename(file_path)}: preset {preset}, {rate_flags}, "
+            f"time {predicted_seconds:.1f}s predicted / {actual_text} actual, "
+            f"size {predicted_bytes / 1048576:.1f} MB predicted / {actual_bytes / 1048576:.1f} MB actual"
+        )
+        total_predicted += predicted_seconds
+        total_actual += actual_seconds or 0.0
+        total_predicted_bytes += predicted_bytes
+        total_actual_bytes += actual_bytes
+    print(
+        f"  Total: {total_predicted / jobs:.0f}s predicted / {total_actual / jobs:.0f}s actual encode time (over {jobs} jobs), "
+        f"{total_predicted_bytes / 1048576:.1f} MB predicted / {total_actual_bytes / 1048576:.1f} MB actual"
+    )
+
+LOUDNESS_CACHE_FILE = "loudness.json"
+MAX_LOUDNESS_GAIN_DB = 20.0
+SILENCE_LUFS = -70.0
+
+def measure_loudness(file_path):
+    # Integrated loudness (EBU R128) of the whole input; the per-frame log is kept below the default log level
+    ffmpeg_command = f'ffmpeg -hide_banner -nostats -i "{file_path}" -vn -af ebur128=framelog=verbose -f null - 2>&1'
+    debug_print(f"Measuring loudness: {ffmpeg_command}")
+    success, output = run_command(ffmpeg_command, timeout=600, retries=0)
+    matches = re.findall(r"I:\s+(-?[\d.]+|-inf)\s+LUFS", output) if success else []
+    if not matches:
+        debug_print(f"Could not measure loudness of {file_path}: {output}")
+        return None
+    return float(matches[-1])
+
+def get_loudness_filters(input_files, cache_dir, target_lufs, jobs, measure=True):
+    # One linear gain per input to bring it to target_lufs, applied while normalizing.
+    # Measurements are cached by content fingerprint, so each clip is analysed once across runs
+    cache_file = os.path.join(cache_dir, LOUDNESS_CACHE_FILE) if cache_dir else None
+    cache = {}
+    if cache_file and os.path.exists(cache_file):
+        try:
+            with open(cache_file, "r") as f:
+                cache = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            debug_print(f"Ignoring unreadable loudness cache {cache_file}")
+    with_audio = [f for f in input_files if has_audio_stream(f)]
+    fingerprints = {f: get_file_hash(f) for f in with_audio}
+    missing = [f for f in with_audio if fingerprints[f] not in cache]
+    if measure and missing:
+        print(f"Measuring loudness of {len(missing)} inputs ({len(with_audio) - len(missing)} cached)")
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            for file_path, loudness in zip(missing, pool.map(measure_loudness, missing)):
+                if loudness is not None and fingerprints[file_path]:
+                    cache[fingerprints[file_path]] = loudness
+        if cache_file:
+            save_metadata(cache_file, cache)
+    filters = {}
+    for file_path in with_audio:
+        loudness = cache.get(fingerprints[file_path])
+        if loudness is None or loudness <= SILENCE_LUFS:
+            continue
+        gain = max(-MAX_LOUDNESS_GAIN_DB, min(MAX_LOUDNESS_GAIN_DB, target_lufs - loudness))
+        # Raising quiet inputs can push peaks past full scale, so boosts go through a limiter at -1 dBFS
+        filters[file_path] = f"volume={gain:.2f}dB" + (",alimiter=limit=0.891:level=disabled" if gain > 0 else "")
+        debug_print(f"Loudness {os.path.basename(file_path)}: {loudness:.1f} LUFS, gain {gain:+.2f} dB")
+    return filters
+
+def save_metadata(metadata_file, metadata):
+    # Write to a temp file and rename so a crash never leaves half-written metadata
+    temp_file = metadata_file + ".tmp"
+    with open(temp_file, "w") as f:
+        json.dump(metadata, f, indent=4)
+    os.replace(temp_file, metadata_file)
+
+def get_name_roles(file_path):
+    # The test plan_input_order sorts by; a path containing both "pic" and "uni" is used in both runs
+    name = file_path.lower()
+    return "pic" in name, "uni" in name
+
+def get_segment_role(file_path):
+    is_pic, is_uni = get_name_roles(file_path)
+    if is_pic and is_uni:
+        return "pic+uni"
+    if is_pic:
+        return "pic"
+    if is_uni:
+        return "uni"
+    return "other"
+
+def plan_input_order(all_files, include_warning=True):
+    # Warning file first, then 2 Pic / 2 Uni chunks, then everything else.
+    # One pass to categorize and one to interleave; a name containing both "pic" and "uni" is used in both runs
+    all_files = list(all_files)
+    input_files = []
+    if include_warning and all_files:
+        input_files.append(all_files.pop(0))  # First file in sorted order
+
+    pic_files, uni_files, other_files = [], [], []
+    for f in all_files:
+        is_pic, is_uni = get_name_roles(f)
+        if is_pic:
+            pic_files.append(f)
+        if is_uni:
+            uni_files.append(f)
+        if not is_pic and not is_uni:
+            other_files.append(f)
+
+    # Sort numerically; the sort is stable so ties keep the alphabetical order
+    pic_files.sort(key=extract_number)
+    uni_files.sort(key=extract_number)
+
+    # Process in 2 Pic, 2 Uni chunks, ensuring all files are included
+    for index in range(0, max(len(pic_files), len(uni_files)), 2):
+        input_files.extend(pic_files[index:index + 2])
+        input_files.extend(uni_files[index:index + 2])
+
+    # Add any remaining other files
+    input_files.extend(other_files)
+
+    return input_files
+
+# Rough encode speed for 1080p at the veryfast preset when no sample encodes were run, in seconds per second of video
+ESTIMATED_SECONDS_PER_SECOND = 0.25
+
+def build_dry_run_plan(input_files, cache_dir, resolution, video_filter_string, ffmpeg_preset, jobs, encode_settings=None, predictions=None, include_warning=True, audio_filters=None):
+    # Everything the full run would do, without encoding: order, probe data, cache hits and estimated encode time
+    with ThreadPoolExecutor(max_workers=max(jobs, 4)) as pool:
+        probes = list(pool.map(probe_file, input_files))
+    target_width, target_height = map(int, resolution.split('x'))
+    pixel_factor = target_width * target_height / (1920 * 1080)
+    segments = []
+    for index, (file_path, info) in enumerate(zip(input_files, probes)):
+        preset, rate_flags = (encode_settings or {}).get(file_path, (ffmpeg_preset, DEFAULT_RATE_FLAGS))
+        audio_filter = (audio_filters or {}).get(file_path, "")
+        cache_settings = get_cache_settings(preset, rate_flags, audio_filter)
+        cache_path = get_segment_cache_path(cache_dir, file_path, resolution, cache_settings, video_filter_string) if cache_dir else None
+        cached = bool(cache_path and os.path.exists(cache_path))
+        if cached:
+            estimate = 0.0
+        elif predictions:
+            estimate = predictions[file_path][0]
+        else:
+            estimate = info["duration"] * pixel_factor * ESTIMATED_SECONDS_PER_SECOND * PRESET_COST[preset] / PRESET_COST[SAMPLE_PRESET]
+        segments.append({
+            "input": file_path.replace(os.sep, '/'),
+            "role": "warning" if include_warning and index == 0 else get_segment_role(file_path),
+            "duration": info["duration"],
+            "width": info["width"],
+            "height": info["height"],
+            "has_audio": info["has_audio"],
+            "probe_ok": info["ok"],
+            "streams": info["streams"],
+            "preset": preset,
+            "rate": rate_flags,
+            "audio_filter": audio_filter,
+            "cached": cached,
+            "estimated_encode_seconds": round(estimate, 1),
+        })
+    total_estimate = sum(segment["estimated_encode_seconds"] for segment in segments)
+    return {
+        "segments": segments,
+        "total_duration": round(sum(segment["duration"] for segment in segments), 3),
+        "cached_segments": sum(1 for segment in segments if segment["cached"]),
+        "jobs": jobs,
+        "estimated_encode_seconds": round(total_estimate / jobs, 1),
+    }
+
+def normalize_segments(input_files, temp_dir, cache_dir, resolution, video_filter_string, ffmpeg_preset, jobs, threads, encode_settings=None, timings=None, audio_filters=None):
+    # Returns the normalized path for every input, in input order; exits on the first failure.
+    # encode_settings maps an input to its own (preset, rate flags) and audio_filters to its audio filter;
+    # timings, if given, receives encode seconds per input
+    # Each segment is (input, output path, cache path); cached inputs have no encode to run
+    encode_settings = encode_settings or {}
+    segments = []
+    pending = []
+    # A clip used twice has one cache path; it is normalized once and the result shared
+    planned = {}
+    duplicates = {}
+    for i, file_path in enumerate(input_files):
+        preset, rate_flags = encode_settings.get(file_path, (ffmpeg_preset, DEFAULT_RATE_FLAGS))
+        audio_filter = (audio_filters or {}).get(file_path, "")
+        cache_settings = get_cache_settings(preset, rate_flags, audio_filter)
+        cache_path = get_segment_cache_path(cache_dir, file_path, resolution, cache_settings, video_filter_string) if cache_dir else None
+        if cache_path and os.path.exists(cache_path):
+            os.utime(cache_path)
+            print(f"Using cached segment for {os.path.basename(file_path)}")
+            segments.append((file_path, cache_path, cache_path))
+            continue
+        if cache_path in planned:
+            duplicates[len(segments)] = planned[cache_path]
+            segments.append((file_path, segments[planned[cache_path]][1], cache_path))
+            continue
+        if cache_path:
+            planned[cache_path] = len(segments)
+            output_path = f"{cache_path[:-4]}.{os.getpid()}.partial.mp4"
+        else:
+            temp_output_name, output_path, _ = get_next_available_name(temp_dir, f"Temp_{i+1}", ".mp4")
+        pending.append(len(segments))
+        segments.append((file_path, output_path, cache_path))
+
+    def timed_normalize(file_path, output_path):
+        preset, rate_flags = encode_settings.get(file_path, (ffmpeg_preset, DEFAULT_RATE_FLAGS))
+        start_time = time.time()
+        audio_filter = (audio_filters or {}).get(file_path, "")
+        result = normalize_segment(file_path, output_path, video_filter_string, preset, threads, cancel_event, rate_flags, audio_filter)
+        if timings is not None:
+            timings[file_path] = time.time() - start_time
+        return result
+
+    # Normalize segments in a bounded pool; results are collected back into the planned order
+    cancel_event = threading.Event()
+    failed = None
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            pool.submit(timed_normalize, segments[index][0], segments[index][1]): index
+            for index in pending
+        }
+        try:
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                index = futures[future]
+                file_path, output_path, cache_path = segments[index]
+                success, output = future.result()
+                if success:
+                    if cache_path:
+                        os.replace(output_path, cache_path)
+                        segments[index] = (file_path, cache_path, cache_path)
+                    print(f"Processed {os.path.basename(file_path)} as {segments[index][1].replace(os.sep, '/')}")
+                elif failed is None:
+                    failed = (index, output)
+                    cancel_event.set()
+                    for other in futures:
+                        other.cancel()
+                    terminate_active_processes()
+        except BaseException:
+            # Ctrl-C: ffmpeg runs in its own process group and never sees it, and leaving the with block
+            # would otherwise wait for every queued normalization
+            cancel_event.set()
+            for other in futures:
+                other.cancel()
+            terminate_active_processes()
+            raise
+    if failed is not None:
+        for index in pending:
+            output_path = segments[index][1]
+            if output_path.endswith(".partial.mp4") and os.path.exists(output_path):
+                os.remove(output_path)
+        index, output = failed
+        print(f"Failed to process {segments[index][0]} into video: {output}")
+        sys.exit(1)
+    for index, first in duplicates.items():
+        file_path, _, cache_path = segments[index]
+        segments[index] = (file_path, segments[first][1], cache_path)
+        print(f"Reused {os.path.basename(segments[first][0])} for {os.path.basename(file_path)}")
+
+    return [output_path for _, output_path, _ in segments]
+
 def extract_number(filename):
-    import re
     match = re.search(r'S\.0*(\d+)', filename)
     return int(match.group(1)) if match else 0
 
@@ -97,9 +862,26 @@ def main():
     parser.add_argument("--debug", action="store_true", help="Enable debug output")
     parser.add_argument("--resolution", default="1920x1080", help="Target resolution (e.g., 1920x1080)")
     parser.add_argument("--quality", type=int, choices=[1, 2, 3], default=3, help="Quality level (1=fastest, 3=slowest/best quality)")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of segments to normalize in parallel (default: 1)")
+    parser.add_argument("--reencode-final", action="store_true", help="Always re-encode the final video through the concat filter instead of joining with stream copy")
+    parser.add_argument("--cache-dir", default=None, help="Folder for cached normalized segments (default: <output-dir>/concat_cache)")
+    parser.add_argument("--cache-size", type=float, default=20, help="Maximum segment cache size in GB, least recently used segments are removed first (default: 20)")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the normalized segment cache")
+    parser.add_argument("--threads", type=int, default=None, help="x264 threads per normalize job (default: CPU count / jobs when --jobs > 1)")
+    parser.add_argument("--time-budget", type=parse_duration, default=None, help="Target time for normalizing all segments, e.g. 10m; presets are chosen per segment from sample encodes")
+    parser.add_argument("--size-target", type=parse_size, default=None, help="Target output size, e.g. 200MB; bitrates are chosen per segment from sample encodes")
+    parser.add_argument("--stream", action="store_true", help="Pipe normalized segments straight into the final muxer without writing them to disk")
+    parser.add_argument("--stream-buffer", type=float, default=64, help="Read-ahead buffer per streaming job in MB (default: 64)")
+    parser.add_argument("--output-format", choices=sorted(OUTPUT_EXTENSIONS), default="mp4", help="mp4, fragmented mp4 with moov first (fmp4), or HLS with fMP4 segments (hls) (default: mp4)")
+    parser.add_argument("--loudness", type=float, default=None, help="Bring every segment to this integrated loudness in LUFS, e.g. -16 (measurements are cached)")
+    parser.add_argument("--dry-run", action="store_true", help="Print the planned order with probe data and estimated encode time as JSON, without encoding")
+    parser.add_argument("--append", action="store_true", help="Normalize only inputs not yet in the existing output and append them with stream copy")
     args = parser.parse_args()
     DEBUG = args.debug
 
+    jobs = max(1, args.jobs)
+    threads = args.threads if args.threads else (max(1, (os.cpu_count() or 1) // jobs) if jobs > 1 else None)
+
     # Map quality level to FFmpeg preset
     preset_map = {1: "ultrafast", 2: "medium", 3: "veryslow"}
     ffmpeg_preset = preset_map[args.quality]
@@ -118,10 +900,15 @@ def main():
     if not os.path.exists(input_dir):
         print(f"Error: Input directory does not exist: {input_dir}")
         sys.exit(1)
-    if not os.path.exists(output_dir):
+    plan_output = sys.stdout
+    if args.dry_run:
+        # Only the JSON plan goes to stdout, so it can be piped into a JSON parser; progress text goes to stderr
+        sys.stdout = sys.stderr
+    if not os.path.exists(output_dir) and not args.dry_run:
         os.makedirs(output_dir)
     temp_dir = os.path.abspath(os.path.join(".", "temp"))
-    if not os.path.exists(temp_dir):
+    # A dry run only needs temp/ for the sample encodes of --time-budget / --size-target
+    if not os.path.exists(temp_dir) and (not args.dry_run or args.time_budget or args.size_target):
         os.makedirs(temp_dir)
 
     # Get all .mp4 files and sort by filename to ensure consistent order
@@ -144,19 +931,19 @@ def main():
     else:
         metadata = {"input_videos": [], "output_video": ""}
     
+    final_output_path = None
     try:
         # Normalize paths for comparison
         existing_videos = set(metadata["input_videos"])
         current_input_videos = [os.path.normpath(f).replace(os.sep, '/') for f in all_files]
         existing_output = metadata.get("output_video", "")
         
-        if existing_output and os.path.exists(existing_output) and all(v in existing_videos for v in current_input_videos):
+        if not args.dry_run and existing_output and os.path.exists(existing_output) and all(v in existing_videos for v in current_input_videos):
             print(f"Skipping: all input files have already been used for {os.path.basename(existing_output)}")
             new_videos = [v.replace(os.sep, '/') for v in all_files if v.replace(os.sep, '/') not in existing_videos]
             if new_videos:
                 metadata["input_videos"].extend(new_videos)
-                with open(metadata_file, "w") as f:
-                    json.dump(metadata, f, indent=4)
+                save_metadata(metadata_file, metadata)
                 print(f"Updated metadata with new videos to {metadata_file.replace(os.sep, '/')}")
             else:
                 print(f"No new videos to add, metadata unchanged at {metadata_file.replace(os.sep, '/')}")
@@ -164,43 +951,7 @@ def main():
 
         debug_print(f"Found files: {all_files}")
 
-        # Categorize and sort files numerically
-        pic_files = sorted([f for f in all_files if "pic" in f.lower()], key=extract_number)
-        uni_files = sorted([f for f in all_files if "uni" in f.lower()], key=extract_number)
-        other_files = [f for f in all_files if f not in pic_files and f not in uni_files]
-
-        # Use the first file as the warning file
-        warning_file = all_files[0]  # First file in sorted order
-        input_files = [warning_file]
-        all_files.remove(warning_file)  # Remove it to avoid duplication
-
-        # Recategorize remaining files
-        pic_files = [f for f in all_files if "pic" in f.lower()]
-        uni_files = [f for f in all_files if "uni" in f.lower()]
-        other_files = [f for f in all_files if f not in pic_files and f not in uni_files]
-
-        # Sort remaining files numerically
-        pic_files.sort(key=extract_number)
-        uni_files.sort(key=extract_number)
-
-        # Process in 2 Pic, 2 Uni chunks, ensuring all files are included
-        pic_index = 0
-        uni_index = 0
-        while pic_index < len(pic_files) or uni_index < len(uni_files):
-            # Add up to 2 Pic files if available
-            input_files.extend(pic_files[pic_index:pic_index + 2])
-            pic_index += 2
-            # Add up to 2 Uni files if available
-            input_files.extend(uni_files[uni_index:uni_index + 2])
-            uni_index += 2
-
-        # Add any remaining other files
-        input_files.extend(other_files)
-
-        debug_print(f"Processing order: {input_files}")
-
         # Process each file to ensure consistent format
-        processed_videos = []
         video_filters = [
             f"scale={target_width}:{target_height}:force_original_aspect_ratio=decrease:force_divisible_by=2",
             f"pad={target_width}:{target_height}:(ow-iw)/2:(oh-ih)/2",
@@ -209,79 +960,147 @@ def main():
         ]
         video_filter_string = ",".join(video_filters)
 
-        for i, file_path in enumerate(input_files):
-            temp_output_name, temp_output_path, _ = get_next_available_name(temp_dir, f"Temp_{i+1}", ".mp4")
-            has_audio = has_audio_stream(file_path)
-            if has_audio:
-                ffmpeg_command = (
-                    f'ffmpeg -y -i "{file_path}" '
-                    f'-c:v libx264 -preset {ffmpeg_preset} -b:v 5000k -r 30 -pix_fmt yuv420p '
-                    f'-force_key_frames "expr:gte(t,n_forced*2)" '
-                    f'-c:a aac -b:a 192k -ar 48000 -ac 2 '
-                    f'-vf "{video_filter_string}" '
-                    f'"{temp_output_path}"'
+        cache_dir = None
+        if not args.no_cache:
+            cache_dir = os.path.abspath(args.cache_dir or os.path.join(output_dir, "concat_cache"))
+            if not args.dry_run:
+                os.makedirs(cache_dir, exist_ok=True)
+
+        # The previous output is rebuilt in place only when it has the extension of the requested format
+        output_extension = OUTPUT_EXTENSIONS[args.output_format]
+        reuse_output = bool(existing_output and os.path.exists(existing_output) and existing_output.endswith(output_extension))
+
+        if args.append and not args.dry_run:
+            if args.output_format == "hls":
+                print("--append is not supported for HLS output, building the full video")
+            elif reuse_output:
+                # Only inputs missing from the metadata are normalized; the existing output is stream copied
+                new_files = [f for f in all_files if os.path.normpath(f).replace(os.sep, '/') not in existing_videos]
+                new_files = plan_input_order(new_files, include_warning=False)
+                debug_print(f"Appending: {new_files}")
+                audio_filters = get_loudness_filters(new_files, cache_dir, args.loudness, jobs) if args.loudness is not None else None
+                new_segments = normalize_segments(
+                    new_files, temp_dir, cache_dir, args.resolution, video_filter_string, ffmpeg_preset, jobs, threads, audio_filters=audio_filters,
                 )
+                append_encode = get_output_encode([(ffmpeg_preset, DEFAULT_RATE_FLAGS)])
+                if can_append(existing_output, new_segments, metadata.get("output_encode"), append_encode):
+                    print(f"Appending {len(new_segments)} new segments to {os.path.basename(existing_output)} with stream copy")
+                    append_path = os.path.join(os.path.dirname(os.path.abspath(existing_output)), f".append.{os.getpid()}.mp4")
+                    success, output = concat_with_demuxer(
+                        [os.path.abspath(existing_output)] + new_segments, append_path, temp_dir, get_container_flags(args.output_format, append_path),
+                    )
+                    if success and os.path.exists(append_path):
+                        os.replace(append_path, existing_output)
+                        metadata["input_videos"].extend(os.path.normpath(f).replace(os.sep, '/') for f in new_files)
+                        save_metadata(metadata_file, metadata)
+                        print(f"Saved as {existing_output} (+{len(new_segments)} segments)")
+                        print(f"Saved metadata to {metadata_file.replace(os.sep, '/')}")
+                        if cache_dir:
+                            prune_segment_cache(cache_dir, int(args.cache_size * 1024 ** 3), keep=new_segments)
+                        sys.exit(0)
+                    print(f"Append failed, rebuilding {os.path.basename(existing_output)}: {output}")
+                    if os.path.exists(append_path):
+                        os.remove(append_path)
+                else:
+                    print(f"New segments do not match {os.path.basename(existing_output)}, rebuilding the full video")
             else:
-                ffmpeg_command = (
-                    f'ffmpeg -y -i "{file_path}" '
-                    f'-f lavfi -i anullsrc=channel_layout=stereo:sample_rate=48000 '
-                    f'-c:v libx264 -preset {ffmpeg_preset} -b:v 5000k -r 30 -pix_fmt yuv420p '
-                    f'-force_key_frames "expr:gte(t,n_forced*2)" '
-                    f'-c:a aac -b:a 192k -ar 48000 -ac 2 -shortest '
-                    f'-vf "{video_filter_string}" '
-                    f'"{temp_output_path}"'
-                )
-            debug_print(f"FFmpeg command for {os.path.basename(file_path)}: {ffmpeg_command}")
-            success, output = run_command(ffmpeg_command, timeout=300, retries=1)
-            if success and os.path.exists(temp_output_path):
-                print(f"Processed {os.path.basename(file_path)} as {temp_output_path.replace(os.sep, '/')}")
+                print("No existing output to append to, building the full video")
+
+        input_files = plan_input_order(all_files)
+
+        debug_print(f"Processing order: {input_files}")
+
+        encode_settings = predictions = None
+        if args.time_budget or args.size_target:
+            print(f"Running sample encodes for {len(input_files)} segments")
+            encode_settings, predictions = plan_encode_budget(
+                input_files, temp_dir, video_filter_string, ffmpeg_preset, jobs, threads, args.time_budget, args.size_target,
+            )
+
+        audio_filters = None
+        if args.loudness is not None:
+            # A dry run only uses measurements that are already cached
+            audio_filters = get_loudness_filters(input_files, cache_dir, args.loudness, jobs, measure=not args.dry_run)
+
+        if args.dry_run:
+            plan = build_dry_run_plan(
+                input_files, None if args.stream else cache_dir, args.resolution, video_filter_string, ffmpeg_preset, jobs, encode_settings, predictions,
+                audio_filters=audio_filters,
+            )
+            plan["output"] = existing_output or None
+            print(json.dumps(plan, indent=4), file=plan_output)
+            return
+
+        if args.stream:
+            # Normalized frames go through pipes only, so the segment cache and temp files are not used
+            final_output_path = existing_output if reuse_output else get_next_available_name(output_dir, "Concat", output_extension)[1]
+            print(f"Streaming {len(input_files)} segments into {os.path.basename(final_output_path)}")
+            timings, sizes = {}, {}
+            success, output = concat_streaming(
+                input_files, final_output_path, video_filter_string, ffmpeg_preset, jobs, threads, args.stream_buffer, encode_settings,
+                get_container_flags(args.output_format, final_output_path), audio_filters, timings, sizes,
+            )
+            if not success:
+                print(f"Concatenation failed: {output}")
+                sys.exit(1)
+            if encode_settings:
+                report_encode_budget(input_files, encode_settings, predictions, timings, sizes, jobs)
+            for file_path in input_files:
                 if file_path.replace(os.sep, '/') not in existing_videos:
                     metadata["input_videos"].append(file_path.replace(os.sep, '/'))
-                processed_videos.append(temp_output_path)
-            else:
-                print(f"Failed to process {file_path} into video: {output}")
-                sys.exit(1)
+            metadata["output_video"] = final_output_path.replace(os.sep, '/')
+            metadata["output_encode"] = get_output_encode(
+                [(encode_settings or {}).get(f, (ffmpeg_preset, DEFAULT_RATE_FLAGS)) for f in input_files]
+            )
+            save_metadata(metadata_file, metadata)
+            print(f"Saved as {final_output_path.replace(os.sep, '/')} ({len(input_files)} segments)")
+            print(f"Saved metadata to {metadata_file.replace(os.sep, '/')}")
+            return
 
-        # Concatenate using concat filter
-        input_string = " ".join([f"-i \"{v}\"" for v in processed_videos])
-        filter_inputs = []
-        stream_map = []
-        for i, video in enumerate(processed_videos):
-            has_audio = has_audio_stream(video)
-            filter_inputs.append(f"[{i}:v]")
-            stream_map.append(f"{i}:v")
-            if has_audio:
-                filter_inputs.append(f"[{i}:a]")
-                stream_map.append(f"{i}:a")
-
-        concat_filter = f"{' '.join(filter_inputs)}concat=n={len(processed_videos)}:v=1:a={1 if any(has_audio_stream(v) for v in processed_videos) else 0}[outv]{'[outa]' if any(has_audio_stream(v) for v in processed_videos) else ''}"
-        map_string = "-map [outv]" + (" -map [outa]" if any(has_audio_stream(v) for v in processed_videos) else " -an")
-        final_output_path = existing_output if existing_output and os.path.exists(existing_output) else os.path.join(output_dir, get_next_available_name(output_dir, "Concat", ".mp4")[1])
-        ffmpeg_command = (
-            f'ffmpeg -y {input_string} '
-            f'-filter_complex "{concat_filter}" '
-            f'{map_string} '
-            f'-c:v libx264 -preset {ffmpeg_preset} -b:v 5000k -r 30 -pix_fmt yuv420p '
-            f'{"-c:a aac -b:a 192k -ar 48000 -ac 2" if any(has_audio_stream(v) for v in processed_videos) else "-an"} '
-            f'"{final_output_path}"'
-        )
-        debug_print(f"FFmpeg concat command: {ffmpeg_command}")
-        success, output = run_command(ffmpeg_command, timeout=600, retries=1)
+        timings = {}
+        normalized = normalize_segments(input_files, temp_dir, cache_dir, args.resolution, video_filter_string, ffmpeg_preset, jobs, threads, encode_settings, timings, audio_filters)
+        if encode_settings:
+            sizes = {f: os.path.getsize(path) for f, path in zip(input_files, normalized) if os.path.exists(path)}
+            report_encode_budget(input_files, encode_settings, predictions, timings, sizes, jobs)
+
+        processed_videos = []
+        for file_path, output_path in zip(input_files, normalized):
+            if file_path.replace(os.sep, '/') not in existing_videos:
+                metadata["input_videos"].append(file_path.replace(os.sep, '/'))
+            processed_videos.append(output_path)
+
+        final_output_path = existing_output if reuse_output else get_next_available_name(output_dir, "Concat", output_extension)[1]
+        container_flags = get_container_flags(args.output_format, final_output_path)
+        segment_presets = [(encode_settings or {}).get(f, (ffmpeg_preset, DEFAULT_RATE_FLAGS))[0] for f in input_files]
+        if not args.reencode_final and segments_match(processed_videos, segment_presets):
+            # Every segment was normalized to the same parameters, so join them without another encode
+            print(f"Joining {len(processed_videos)} segments with stream copy")
+            success, output = concat_with_demuxer(processed_videos, final_output_path, temp_dir, container_flags)
+            output_encode = get_output_encode([(encode_settings or {}).get(f, (ffmpeg_preset, DEFAULT_RATE_FLAGS)) for f in input_files])
+        else:
+            success, output = concat_with_filter(processed_videos, final_output_path, ffmpeg_preset, container_flags)
+            output_encode = get_output_encode([(ffmpeg_preset, DEFAULT_RATE_FLAGS)])
         if success:
             print(f"Saved as {final_output_path.replace(os.sep, '/')} ({len(processed_videos)} segments)")
             metadata["output_video"] = final_output_path.replace(os.sep, '/')
-            with open(metadata_file, "w") as f:
-                json.dump(metadata, f, indent=4)
+            metadata["output_encode"] = output_encode
+            save_metadata(metadata_file, metadata)
             print(f"Saved metadata to {metadata_file.replace(os.sep, '/')}")
-            # Clean up temporary files
+            # Clean up temporary files; cached segments are kept for the next run
             for video in processed_videos:
-                if os.path.exists(video):
+                if video.startswith(temp_dir) and os.path.exists(video):
                     os.remove(video)
                     debug_print(f"Removed temporary file: {video}")
+            if cache_dir:
+                prune_segment_cache(cache_dir, int(args.cache_size * 1024 ** 3), keep=processed_videos)
         else:
             print(f"Concatenation failed: {output}")
             sys.exit(1)
     finally:
+        terminate_active_processes()
+        # Also reached on Ctrl-C, so an empty Concat_N placeholder never keeps the number
+        if final_output_path:
+            release_name(final_output_path)
         if os.path.exists(temp_dir):
             shutil.rmtree(temp_dir, ignore_errors=True)
 
@@ -6,11 +6,23 @@ import glob
 import json
 import time
 import re
-from PIL import Image
+from PIL import Image, features
 import logging
 import shutil
 import hashlib
-import uuid
+import sqlite3
+import io
+import queue
+import threading
+import signal
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import pillow_avif  # noqa: F401 - registers the AVIF plugin on older Pillow
+except ImportError:
+    pillow_avif = None
 
 logging.basicConfig(
     level=logging.INFO,
@@ -26,13 +38,48 @@ def debug_print(*args, **kwargs):
     if DEBUG:
         logger.debug(*args, **kwargs)
 
-def run_command(command, suppress_errors=False, timeout=None, retries=1):
+_active_processes = {}
+_process_lock = threading.Lock()
+_stopping = False
+
+def start_process(command, cancel_event=None, **kwargs):
+    # Starts command in its own process group and tracks it, so it can be killed with its whole tree;
+    # returns None once cancel_event is set (checked under the lock terminate_active_processes takes)
+    with _process_lock:
+        if _stopping or (cancel_event is not None and cancel_event.is_set()):
+            return None
+        process = subprocess.Popen(command, shell=True, text=True, start_new_session=(os.name != "nt"), **kwargs)
+        _active_processes[process] = cancel_event
+    return process
+
+def finish_process(process):
+    # Also reached on Ctrl-C: ffmpeg runs in its own process group and would not see the signal
+    if process.poll() is None:
+        kill_process_tree(process)
+    with _process_lock:
+        _active_processes.pop(process, None)
+
+def terminate_active_processes(cancel_event=None):
+    # Kills the commands started with cancel_event, or with no event every running command,
+    # and then nothing new is started (used when the whole run is interrupted)
+    global _stopping
+    with _process_lock:
+        if cancel_event is None:
+            _stopping = True
+        processes = [process for process, event in _active_processes.items() if cancel_event is None or event is cancel_event]
+    for process in processes:
+        if process.poll() is None:
+            kill_process_tree(process)
+
+def run_command(command, suppress_errors=False, timeout=None, retries=1, cancel_event=None):
     attempt = 0
     while attempt < retries:
         debug_print(f"Running command (Attempt {attempt+1}/{retries}): {command}")
         stdout = subprocess.PIPE if not suppress_errors else subprocess.DEVNULL
         stderr = subprocess.PIPE if not suppress_errors else subprocess.DEVNULL
-        process = subprocess.Popen(command, shell=True, stdout=stdout, stderr=stderr, text=True)
+        process = start_process(command, cancel_event, stdout=stdout, stderr=stderr)
+        if process is None:
+            return False, "Cancelled"
         try:
             stdout_data, stderr_data = process.communicate(timeout=timeout)
             if stdout_data:
@@ -45,7 +92,7 @@ def run_command(command, suppress_errors=False, timeout=None, retries=1):
                 return False, stdout_data + "\n" + stderr_data
             return True, stdout_data
         except subprocess.TimeoutExpired:
-            process.kill()
+            kill_process_tree(process)
             if attempt < retries - 1:
                 debug_print(f"Timeout after {timeout}s. Retrying {attempt+1}/{retries}")
                 time.sleep(2)
@@ -54,22 +101,186 @@ def run_command(command, suppress_errors=False, timeout=None, retries=1):
             debug_print(f"Timeout after {timeout}s. No more retries")
             return False, f"Timeout after {timeout}s"
         except Exception as ex:
-            process.kill()
+            kill_process_tree(process)
             debug_print(f"Command execution error: {ex}")
             return False, str(ex)
         finally:
-            if process.poll() is None:
-                process.terminate()
+            finish_process(process)
+
+PROGRESS_LOG_INTERVAL = 5
+_metrics_lock = threading.Lock()
+
+def new_run_metrics(stall_timeout):
+    return {"start": time.monotonic(), "stall_timeout": stall_timeout, "files": []}
+
+def kill_process_tree(process):
+    # shell=True puts ffmpeg under a shell, so kill the whole group rather than just the shell
+    if os.name == "nt":
+        subprocess.run(f"taskkill /F /T /PID {process.pid}", shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    else:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+def run_ffmpeg_progress(command, label, total_seconds, metrics, entries=None, cancel_event=None):
+    # Runs an ffmpeg command that includes "-progress pipe:1", logging speed/ETA and killing it when output stops advancing.
+    # With entries, the result goes there instead of the run totals (used for chunks, recorded as one file by the caller)
+    process = start_process(command, cancel_event, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process is None:
+        return False, "Cancelled"
+    lines = queue.Queue()
+    stderr_lines = []
+
+    def read_stdout():
+        for line in process.stdout:
+            lines.put(line)
+        lines.put(None)
+
+    def read_stderr():
+        for line in process.stderr:
+            stderr_lines.append(line)
+
+    readers = [threading.Thread(target=read_stdout, daemon=True), threading.Thread(target=read_stderr, daemon=True)]
+    for reader in readers:
+        reader.start()
+
+    state = {}
+    start = last_advance = last_log = time.monotonic()
+    out_time, stalled = 0.0, False
+    done = False
+    try:
+        while True:
+            try:
+                line = lines.get(timeout=1)
+            except queue.Empty:
+                line = ""
+            if line is None:
+                done = True
+                break
+            key, _, value = line.strip().partition("=")
+            if key:
+                state[key] = value.strip()
+            now = time.monotonic()
+            if key == "progress":
+                try:
+                    current = int(state.get("out_time_us") or state.get("out_time_ms") or 0) / 1_000_000
+                except ValueError:
+                    current = out_time
+                if current > out_time:
+                    out_time, last_advance = current, now
+                if now - last_log >= PROGRESS_LOG_INTERVAL:
+                    last_log = now
+                    speed = state.get("speed", "N/A")
+                    percent = f"{min(out_time / total_seconds, 1) * 100:.0f}%" if total_seconds else f"{out_time:.0f}s"
+                    eta = ""
+                    if total_seconds and speed.endswith("x"):
+                        try:
+                            eta = f", ETA {max(total_seconds - out_time, 0) / float(speed[:-1]):.0f}s"
+                        except (ValueError, ZeroDivisionError):
+                            pass
+                    logger.info(f"{label}: {percent}, {state.get('fps', '0')} fps, {speed}, {int(state.get('total_size', 0) or 0) / 1048576:.1f} MB{eta}")
+            if now - last_advance > metrics["stall_timeout"]:
+                stalled = True
+                logger.error(f"{label}: no progress for {metrics['stall_timeout']}s, stopping encode")
+                break
+    finally:
+        # Covers the stall break as well as Ctrl-C or any error raised while reading progress
+        if not done and process.poll() is None:
+            kill_process_tree(process)
+
+    elapsed = time.monotonic() - start
+    process.wait()
+    finish_process(process)
+    for reader in readers:
+        reader.join(timeout=5)
+    success = process.returncode == 0 and not stalled
+    try:
+        frames = int(state.get("frame", 0) or 0)
+        size = int(state.get("total_size", 0) or 0)
+    except ValueError:
+        frames, size = 0, 0
+    entry = {
+        "file": label,
+        "status": "ok" if success else "stalled" if stalled else "failed",
+        "elapsed": round(elapsed, 3),
+        "media_seconds": round(out_time, 3),
+        "frames": frames,
+        "bytes": size,
+        "fps": round(frames / elapsed, 2) if elapsed else 0,
+        "speed": round(out_time / elapsed, 3) if elapsed else 0,
+    }
+    if entries is not None:
+        with _metrics_lock:
+            entries.append(entry)
+        logger.info(f"{label}: {entry['status']} in {elapsed:.1f}s ({entry['fps']} fps, {entry['speed']}x)")
+    else:
+        record_metrics_entry(metrics, entry)
+    if success:
+        return True, ""
+    if stalled:
+        return False, f"Stalled after {out_time:.1f}s of output"
+    return False, "".join(stderr_lines[-20:])
+
+def record_metrics_entry(metrics, entry):
+    with _metrics_lock:
+        metrics["files"].append(entry)
+        totals = summarize_metrics(metrics)
+    logger.info(
+        f"{entry['file']}: {entry['status']} in {entry['elapsed']:.1f}s ({entry['fps']} fps, {entry['speed']}x). "
+        f"Run total: {totals['files']} files, {totals['fps']} fps, {totals['speed']}x, {totals['bytes'] / 1048576:.1f} MB"
+    )
+
+def summarize_metrics(metrics):
+    wall = time.monotonic() - metrics["start"]
+    files = metrics["files"]
+    frames = sum(entry["frames"] for entry in files)
+    media_seconds = sum(entry["media_seconds"] for entry in files)
+    return {
+        "files": len(files),
+        "failed": sum(1 for entry in files if entry["status"] == "failed"),
+        "stalled": sum(1 for entry in files if entry["status"] == "stalled"),
+        "wall_seconds": round(wall, 3),
+        "media_seconds": round(media_seconds, 3),
+        "frames": frames,
+        "bytes": sum(entry["bytes"] for entry in files),
+        "fps": round(frames / wall, 2) if wall else 0,
+        "speed": round(media_seconds / wall, 3) if wall else 0,
+    }
+
+def write_run_metrics(metrics, output_dir):
+    # One JSON object per run, appended so encoder throughput can be compared over time
+    summary = summarize_metrics(metrics)
+    summary["timestamp"] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+    summary["per_file"] = metrics["files"]
+    metrics_file = os.path.join(output_dir, "conversion_metrics.jsonl")
+    with open(metrics_file, 'a') as f:
+        f.write(json.dumps(summary) + "\n")
+    logger.info(
+        f"Encode summary: {summary['files']} files ({summary['failed']} failed, {summary['stalled']} stalled), "
+        f"{summary['fps']} fps, {summary['speed']}x, {summary['bytes'] / 1048576:.1f} MB. Saved to {metrics_file}"
+    )
+
+FINGERPRINT_SAMPLE_SIZE = 64 * 1024
 
-def get_file_hash(file_path):
-    hash_md5 = hashlib.md5()
+def get_file_hash(file_path, sample_size=FINGERPRINT_SAMPLE_SIZE):
+    # Hash of size plus head/middle/tail samples; small files are hashed in full
     try:
+        size = os.path.getsize(file_path)
+        hash_obj = hashlib.blake2b(digest_size=16)
+        hash_obj.update(str(size).encode())
         with open(file_path, 'rb') as f:
-            for chunk in iter(lambda: f.read(4096), b''):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()[:8]
-    except Exception:
-        return str(uuid.uuid4())[:8]
+            if size <= sample_size * 3:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    hash_obj.update(chunk)
+            else:
+                for offset in (0, (size - sample_size) // 2, size - sample_size):
+                    f.seek(offset)
+                    hash_obj.update(f.read(sample_size))
+        return hash_obj.hexdigest()
+    except OSError as e:
+        debug_print(f"Could not hash {file_path}: {e}")
+        return None
 
 def get_video_dimensions(video_path):
     command = f'ffprobe -v error -select_streams v:0 -show_entries stream=width,height -of json "{video_path}"'
@@ -84,65 +295,155 @@ def get_video_dimensions(video_path):
     logger.warning(f"Could not get dimensions for {video_path}. Using 1920x1080")
     return 1920, 1080
 
-def convert_image(input_path, output_path, target_ratio=None, crop=False):
+def parse_frame_rate(rate):
+    try:
+        num, _, den = rate.partition('/')
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError, AttributeError):
+        return 0.0
+
+def probe_video(video_path):
+    command = (
+        f'ffprobe -v error -show_entries stream=codec_type,codec_name,width,height,pix_fmt,avg_frame_rate,r_frame_rate,sample_rate,channels'
+        f':format=duration -of json "{video_path}"'
+    )
+    success, output = run_command(command)
+    if not success:
+        return None
+    try:
+        data = json.loads(output)
+    except json.JSONDecodeError:
+        logger.warning(f"JSON decode error for {video_path}: {output}")
+        return None
+    streams = data.get('streams', [])
+    return {
+        "video": next((st for st in streams if st.get('codec_type') == 'video'), None),
+        "audio": next((st for st in streams if st.get('codec_type') == 'audio'), None),
+        "duration": float(data.get('format', {}).get('duration') or 0),
+    }
+
+def get_stream_copy_plan(probe, target_ratio=None):
+    # Returns (copy_video, copy_audio): which streams already match the libx264/AAC output profile
+    if not probe or not probe["video"]:
+        return False, False
+    video = probe["video"]
+    width, height = video.get("width") or 0, video.get("height") or 0
+    fps = parse_frame_rate(video.get("avg_frame_rate")) or parse_frame_rate(video.get("r_frame_rate"))
+    copy_video = (
+        video.get("codec_name") == "h264"
+        and video.get("pix_fmt") == "yuv420p"
+        and abs(fps - 30) < 0.01
+        and width % 2 == 0 and height % 2 == 0
+    )
+    if target_ratio == "9:16":
+        # Only copy when the scale filter would leave the frame unchanged
+        copy_video = copy_video and ((width == 540 and height <= 960) or (height == 960 and width <= 540))
+    audio = probe["audio"]
+    copy_audio = audio is None or (
+        audio.get("codec_name") == "aac"
+        and str(audio.get("sample_rate")) == "44100"
+        and (audio.get("channels") or 0) <= 2
+    )
+    return copy_video, copy_audio
+
+IMAGE_FORMATS = {
+    "jpeg": ("JPEG", ".jpg"),
+    "webp": ("WEBP", ".webp"),
+    "avif": ("AVIF", ".avif"),
+}
+
+def get_image_geometry(width, height, target_ratio=None, crop=False):
+    # Returns (stretch_size, crop_box, final_size) in source pixel coordinates; None means skip the step
+    stretch, box, final = None, None, None
+    if target_ratio == "9:16":
+        original_aspect = width / height
+        if abs(original_aspect - 9 / 16) < 0.1:  # Close to 9:16, stretch proportionally
+            if original_aspect > 9 / 16:
+                stretch = (width, int(width * (16 / 9)))
+            else:
+                stretch = (int(height * (9 / 16)), height)
+        if crop:
+            if original_aspect > 9 / 16:
+                new_width = int(height * (9 / 16))
+                left = (width - new_width) // 2
+                box = (left, 0, left + new_width, height)
+            else:
+                new_height = int(width * (16 / 9))
+                top = (height - new_height) // 2
+                box = (0, top, width, top + new_height)
+            crop_width, crop_height = box[2] - box[0], box[3] - box[1]
+            final = (int(crop_width * 540 / max(crop_width, crop_height * 9 / 16)), 540)
+    elif target_ratio == "1:1":
+        if abs(width / height - 1) < 0.1:
+            stretch = (width, width) if width > height else (height, height)
+        if crop:
+            if width > height:
+                left = (width - height) // 2
+                box = (left, 0, left + height, height)
+            else:
+                top = (height - width) // 2
+                box = (0, top, width, top + width)
+            side = max(box[2] - box[0], box[3] - box[1])
+            final = (side, side)
+    return stretch, box, final
+
+def fit_max_size(size, max_size):
+    if not max_size or max(size) <= max_size:
+        return size
+    scale = max_size / max(size)
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+def encode_image(img, pil_format, quality, target_kb=None):
+    # Highest quality that fits target_kb (binary search), or a single encode at the given quality
+    def encode(q):
+        buffer = io.BytesIO()
+        img.save(buffer, pil_format, quality=q)
+        return buffer.getvalue()
+    if not target_kb:
+        return encode(quality)
+    low, high, best = 10, quality, None
+    while low <= high:
+        mid = (low + high) // 2
+        data = encode(mid)
+        if len(data) <= target_kb * 1024:
+            best, low = data, mid + 1
+        else:
+            high = mid - 1
+    return best if best is not None else encode(10)
+
+def convert_image(input_path, output_path, target_ratio=None, crop=False, image_format="jpeg", quality=90, max_size=None, target_kb=None):
+    temp_output_path = output_path + ".tmp"
     try:
         with Image.open(input_path) as img:
-            img = img.convert("RGB")
             width, height = img.size
             debug_print(f"Image {input_path} size: {width}x{height}")
+            stretch, box, final = get_image_geometry(width, height, target_ratio, crop)
+            crop_width = box[2] - box[0] if box else (stretch or (width, height))[0]
+            crop_height = box[3] - box[1] if box else (stretch or (width, height))[1]
+            final = fit_max_size(final or (crop_width, crop_height), max_size)
 
-            new_img = img.copy()
-            if target_ratio == "9:16":
-                target_aspect = 9 / 16
-                original_aspect = width / height
+            # Let the JPEG decoder downscale by 1/2, 1/4 or 1/8 when the output is smaller than the source
+            if img.format == "JPEG" and (final[0] < crop_width or final[1] < crop_height):
+                scale = max(final[0] / crop_width, final[1] / crop_height)
+                img.draft("RGB", (int(width * scale) + 1, int(height * scale) + 1))
+            new_img = img if img.mode == "RGB" else img.convert("RGB")
+            scale_x, scale_y = new_img.width / width, new_img.height / height
+            if (scale_x, scale_y) != (1, 1):
+                debug_print(f"Draft decoded {input_path} at {new_img.width}x{new_img.height}")
 
-                if abs(original_aspect - target_aspect) < 0.1:  # Close to 9:16, stretch proportionally
-                    if original_aspect > target_aspect:
-                        new_height = int(width * (16 / 9))
-                        new_img = new_img.resize((width, new_height), Image.Resampling.LANCZOS)
-                    else:
-                        new_width = int(height * (9 / 16))
-                        new_img = new_img.resize((new_width, height), Image.Resampling.LANCZOS)
-                if crop:
-                    if original_aspect > target_aspect:
-                        new_width = int(height * (9 / 16))
-                        left = (width - new_width) // 2
-                        new_img = new_img.crop((left, 0, left + new_width, height))
-                    else:
-                        new_height = int(width * (16 / 9))
-                        top = (height - new_height) // 2
-                        new_img = new_img.crop((0, top, width, top + new_height))
-                    new_img = new_img.resize((int(new_img.width * 540 / max(new_img.width, new_img.height * 9 / 16)), 540), Image.Resampling.LANCZOS)
-
-            elif target_ratio == "1:1":
-                target_aspect = 1
-                original_aspect = width / height
-
-                if abs(original_aspect - target_aspect) < 0.1:
-                    if width > height:
-                        new_height = width
-                        new_img = new_img.resize((width, new_height), Image.Resampling.LANCZOS)
-                    else:
-                        new_width = height
-                        new_img = new_img.resize((new_width, height), Image.Resampling.LANCZOS)
-                if crop:
-                    if width > height:
-                        new_height = height
-                        left = (width - height) // 2
-                        new_img = new_img.crop((left, 0, left + new_height, height))
-                    else:
-                        new_width = width
-                        top = (height - width) // 2
-                        new_img = new_img.crop((0, top, new_width, top + new_width))
-                    new_img = new_img.resize((max(new_img.width, new_img.height), max(new_img.width, new_img.height)), Image.Resampling.LANCZOS)
+            if stretch:
+                new_img = new_img.resize((round(stretch[0] * scale_x), round(stretch[1] * scale_y)), Image.Resampling.LANCZOS, reducing_gap=3.0)
+            if box:
+                new_img = new_img.crop((round(box[0] * scale_x), round(box[1] * scale_y), round(box[2] * scale_x), round(box[3] * scale_y)))
+            if new_img.size != final:
+                new_img = new_img.resize(final, Image.Resampling.LANCZOS, reducing_gap=3.0)
 
-            else:
-                new_img = img
-
-            temp_output_path = output_path + ".tmp"
-            new_img.save(temp_output_path, "JPEG", quality=100)
+            pil_format = IMAGE_FORMATS[image_format][0]
+            data = encode_image(new_img, pil_format, quality, target_kb)
+            with open(temp_output_path, 'wb') as f:
+                f.write(data)
             os.replace(temp_output_path, output_path)
-            debug_print(f"Converted {input_path} to {output_path} (Size: {new_img.size}) with ratio {target_ratio}")
+            debug_print(f"Converted {input_path} to {output_path} (Size: {new_img.size}, {len(data)} bytes) with ratio {target_ratio}")
             return True
     except Exception as e:
         logger.error(f"Image conversion error for {input_path}: {e}")
@@ -151,39 +452,185 @@ def convert_image(input_path, output_path, target_ratio=None, crop=False):
             debug_print(f"Removed failed temp file: {temp_output_path}")
         return False
 
-def convert_video(input_path, output_path, target_ratio=None, duration=None):
-    ffmpeg_path = "ffmpeg"
-    debug_print(f"Testing FFmpeg at {ffmpeg_path}")
-    success, output = run_command(f'"{ffmpeg_path}" -version')
-    if not success:
-        debug_print(f"FFmpeg not found via PATH. Output: {output}")
-        ffmpeg_path = r"C:\ffmpeg\bin\ffmpeg.exe"
-        debug_print(f"Trying explicit path {ffmpeg_path}")
+_ffmpeg_path = None
+
+def find_ffmpeg():
+    global _ffmpeg_path
+    if _ffmpeg_path:
+        return _ffmpeg_path
+    for ffmpeg_path in ("ffmpeg", r"C:\ffmpeg\bin\ffmpeg.exe"):
+        debug_print(f"Testing FFmpeg at {ffmpeg_path}")
         success, output = run_command(f'"{ffmpeg_path}" -version')
+        if success:
+            _ffmpeg_path = ffmpeg_path
+            return ffmpeg_path
+        debug_print(f"FFmpeg not found at {ffmpeg_path}. Output: {output}")
+    logger.error("FFmpeg not found in PATH or at C:\\ffmpeg\\bin. Install or adjust path.")
+    return None
+
+def get_video_filter(target_ratio=None):
+    if target_ratio == "9:16":
+        return "scale=540:960:force_original_aspect_ratio=decrease,pad=ceil(iw/2)*2:ceil(ih/2)*2:0:0"
+    return None
+
+def get_video_flags(video_filter=None):
+    flags = "-c:v libx264 -preset ultrafast -b:v 3500k"
+    if video_filter:
+        flags += f' -vf "{video_filter}"'
+    return flags + " -r 30"
+
+AUDIO_ENCODE_FLAGS = "-c:a aac -b:a 128k -ar 44100"
+
+def run_encode(command, label, probe, duration, metrics=None, retries=2, entries=None, cancel_event=None):
+    if metrics is None:
+        return run_command(command, retries=retries, cancel_event=cancel_event)
+    total_seconds = probe["duration"] if probe else 0
+    if duration is not None:
+        total_seconds = min(total_seconds, duration) if total_seconds else duration
+    return run_ffmpeg_progress(command, label, total_seconds, metrics, entries=entries, cancel_event=cancel_event)
+
+def record_chunked_entry(metrics, label, entries, elapsed, status, output_path):
+    # Rolls the chunk and audio encodes up into one per-file entry; media time and frames come from the video chunks
+    if any(entry["status"] == "stalled" for entry in entries):
+        status = "stalled"
+    video_entries = [entry for entry in entries if not entry["file"].endswith(" audio")]
+    media_seconds = sum(entry["media_seconds"] for entry in video_entries)
+    frames = sum(entry["frames"] for entry in video_entries)
+    size = os.path.getsize(output_path) if status == "ok" else sum(entry["bytes"] for entry in entries)
+    record_metrics_entry(metrics, {
+        "file": label,
+        "status": status,
+        "elapsed": round(elapsed, 3),
+        "media_seconds": round(media_seconds, 3),
+        "frames": frames,
+        "bytes": size,
+        "fps": round(frames / elapsed, 2) if elapsed else 0,
+        "speed": round(media_seconds / elapsed, 3) if elapsed else 0,
+        "chunks": len(video_entries),
+    })
+
+def convert_video_chunked(input_path, output_path, target_ratio=None, duration=None, threads=None, copy_audio=False, has_audio=True, chunking=None, probe=None, metrics=None):
+    # Splits the video at keyframes (stream copy), encodes the chunks in parallel, encodes audio once
+    # as a single continuous stream, then joins everything with the concat demuxer without re-encoding
+    ffmpeg_path = find_ffmpeg()
+    if not ffmpeg_path:
+        return False
+    start = time.monotonic()
+    label = os.path.basename(input_path)
+    entries = [] if metrics is not None else None
+    status = "failed"
+    progress_flag = "-progress pipe:1 -nostats " if metrics is not None else ""
+    thread_budget = threads or os.cpu_count() or 1
+    chunk_jobs = chunking["jobs"] or max(1, thread_budget // 4)
+    chunk_threads = max(1, thread_budget // chunk_jobs)
+    duration_flag = f"-t {duration}" if duration is not None else ""
+    chunk_dir = tempfile.mkdtemp(prefix=".chunks_", dir=os.path.dirname(output_path) or ".")
+    temp_output_path = output_path + ".tmp"
+    try:
+        split_command = (
+            f'"{ffmpeg_path}" -y -i "{input_path}" {duration_flag} -map 0:v:0 -c copy -f segment '
+            f'-segment_time {chunking["seconds"]} -reset_timestamps 1 "{os.path.join(chunk_dir, "src_%05d.mkv")}"'
+        )
+        debug_print(f"Splitting: {split_command}")
+        success, output = run_command(split_command)
         if not success:
-            logger.error(f"FFmpeg not found at {ffmpeg_path}. Install or adjust path.")
+            logger.error(f"Chunk split failed for {input_path}: {output}")
             return False
+        sources = sorted(name for name in os.listdir(chunk_dir) if name.startswith("src_"))
+        logger.info(f"Encoding {input_path} as {len(sources)} chunks ({chunk_jobs} parallel, {chunk_threads} threads each)")
+
+        video_flags = get_video_flags(get_video_filter(target_ratio))
+        # path -> (command, label, probe, duration) for run_encode; chunks use the chunk length as their progress total
+        commands = {}
+        for index, name in enumerate(sources, 1):
+            encoded_path = os.path.join(chunk_dir, "enc_" + os.path.splitext(name)[0][4:] + ".mp4")
+            command = f'"{ffmpeg_path}" {progress_flag}-y -i "{os.path.join(chunk_dir, name)}" -an {video_flags} -threads {chunk_threads} "{encoded_path}"'
+            commands[encoded_path] = (command, f"{label} chunk {index}/{len(sources)}", None, chunking["seconds"])
+        audio_path = os.path.join(chunk_dir, "audio.m4a")
+        if has_audio:
+            audio_flags = "-c:a copy" if copy_audio else AUDIO_ENCODE_FLAGS
+            command = f'"{ffmpeg_path}" {progress_flag}-y -i "{input_path}" {duration_flag} -vn -map 0:a:0 {audio_flags} "{audio_path}"'
+            commands[audio_path] = (command, f"{label} audio", probe, duration)
+
+        # Only this video's chunks are started with cancel_event, so stopping them leaves other --jobs encodes alone
+        cancel_event = threading.Event()
+        with ThreadPoolExecutor(max_workers=chunk_jobs) as chunk_pool:
+            futures = {
+                chunk_pool.submit(run_encode, command, chunk_label, chunk_probe, chunk_duration, metrics, 1, entries, cancel_event): path
+                for path, (command, chunk_label, chunk_probe, chunk_duration) in commands.items()
+            }
+            try:
+                for future in as_completed(futures):
+                    success, output = future.result()
+                    if not success:
+                        logger.error(f"Chunk encode failed for {futures[future]}: {output}")
+                        return False
+            finally:
+                # Reached on a failed chunk, Ctrl-C or any error; after a clean loop every chunk is already done
+                cancel_event.set()
+                for other in futures:
+                    other.cancel()
+                terminate_active_processes(cancel_event)
 
-    width, height = get_video_dimensions(input_path)
+        list_path = os.path.join(chunk_dir, "chunks.txt")
+        with open(list_path, 'w') as f:
+            for path in commands:
+                if path != audio_path:
+                    f.write(f"file '{os.path.basename(path)}'\n")
+        audio_input = f'-i "{audio_path}" -map 0:v:0 -map 1:a:0' if has_audio else "-map 0:v:0"
+        join_command = f'"{ffmpeg_path}" -y -f concat -safe 0 -i "{list_path}" {audio_input} -c copy -f mp4 "{temp_output_path}"'
+        debug_print(f"Joining: {join_command}")
+        success, output = run_command(join_command)
+        if not success:
+            logger.error(f"Chunk join failed for {input_path}: {output}")
+            return False
+        os.replace(temp_output_path, output_path)
+        status = "ok"
+        debug_print(f"Saved as {output_path.replace(os.sep, '/')} from {len(sources)} chunks")
+        return True
+    finally:
+        if entries:
+            record_chunked_entry(metrics, label, entries, time.monotonic() - start, status, output_path)
+        if os.path.exists(temp_output_path):
+            os.remove(temp_output_path)
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+
+def convert_video(input_path, output_path, target_ratio=None, duration=None, threads=None, stream_copy=True, metrics=None, chunking=None):
+    ffmpeg_path = find_ffmpeg()
+    if not ffmpeg_path:
+        return False
+
+    probe = probe_video(input_path)
+    if probe and probe["video"]:
+        width, height = probe["video"].get("width"), probe["video"].get("height")
+    else:
+        width, height = get_video_dimensions(input_path)
     debug_print(f"Video {input_path} size: {width}x{height}")
 
+    copy_video, copy_audio = get_stream_copy_plan(probe, target_ratio) if stream_copy else (False, False)
+    debug_print(f"Stream copy plan for {input_path}: video={copy_video}, audio={copy_audio}")
+
+    if chunking and not copy_video and probe:
+        effective_duration = min(probe["duration"], duration) if duration is not None else probe["duration"]
+        if effective_duration > chunking["threshold"]:
+            return convert_video_chunked(
+                input_path, output_path, target_ratio=target_ratio, duration=duration, threads=threads,
+                copy_audio=copy_audio, has_audio=probe["audio"] is not None, chunking=chunking, probe=probe, metrics=metrics,
+            )
+
     duration_flag = f"-t {duration}" if duration is not None else ""
-    if target_ratio == "9:16":
-        temp_output_path = output_path + ".tmp"
-        ffmpeg_command = (
-            f'"{ffmpeg_path}" -y -i "{input_path}" -c:v libx264 -preset ultrafast -b:v 3500k '
-            f'-vf "scale=540:960:force_original_aspect_ratio=decrease,pad=ceil(iw/2)*2:ceil(ih/2)*2:0:0" '
-            f'-r 30 -c:a aac -b:a 128k -ar 44100 {duration_flag} -f mp4 "{temp_output_path}"'
-        )
-    else:
-        temp_output_path = output_path + ".tmp"
-        ffmpeg_command = (
-            f'"{ffmpeg_path}" -y -i "{input_path}" -c:v libx264 -preset ultrafast -b:v 3500k '
-            f'-r 30 -c:a aac -b:a 128k -ar 44100 {duration_flag} -f mp4 "{temp_output_path}"'
-        )
+    threads_flag = f"-threads {threads}" if threads else ""
+    temp_output_path = output_path + ".tmp"
+    video_flags = "-c:v copy" if copy_video else get_video_flags(get_video_filter(target_ratio))
+    audio_flags = "-c:a copy" if copy_audio else AUDIO_ENCODE_FLAGS
+    progress_flag = "-progress pipe:1 -nostats " if metrics is not None else ""
+    ffmpeg_command = (
+        f'"{ffmpeg_path}" {progress_flag}-y -i "{input_path}" {video_flags} '
+        f'{audio_flags} {duration_flag} {threads_flag} -f mp4 "{temp_output_path}"'
+    )
 
     debug_print(f"Executing: {ffmpeg_command}")
-    success, output = run_command(ffmpeg_command, retries=2)
+    success, output = run_encode(ffmpeg_command, os.path.basename(input_path), probe, duration, metrics)
     if success:
         out_width, out_height = get_video_dimensions(temp_output_path)
         debug_print(f"Output dimensions: {out_width}x{out_height}")
@@ -197,76 +644,347 @@ def convert_video(input_path, output_path, target_ratio=None, duration=None):
             debug_print(f"Removed failed temp file: {temp_output_path}")
         return False
 
-def get_files_recursive(directory, extensions):
-    files = []
-    input_dir = os.path.abspath(directory)  # Base directory for input
-    for root, _, filenames in os.walk(directory):
-        full_root = os.path.abspath(root)
-        for filename in filenames:
-            file_path = os.path.join(root, filename)
-            abs_file_path = os.path.abspath(file_path)
-            if any(filename.lower().endswith(ext) for ext in extensions):
-                # Only include files directly under input_dir
-                if abs_file_path.startswith(input_dir) and not any(abs_file_path.startswith(os.path.join(input_dir, subdir)) for subdir in ['converted_videos', 'converted_pictures', 'converted', 'converted_one_to_one', 'converted_nine_sixteen']):
-                    files.append(file_path)
-                    debug_print(f"Included file: {file_path}")
+def convert_video_renditions(input_path, outputs, duration=None, threads=None, stream_copy=True, metrics=None):
+    # outputs is a list of (target_ratio, output_path); the input is decoded once and split across all encoders
+    ffmpeg_path = find_ffmpeg()
+    if not ffmpeg_path:
+        return False
+
+    probe = probe_video(input_path)
+    has_audio = bool(probe and probe["audio"])
+    duration_flag = f"-t {duration}" if duration is not None else ""
+    threads_flag = f"-threads {threads}" if threads else ""
+    plans = [get_stream_copy_plan(probe, target_ratio) if stream_copy else (False, False) for target_ratio, _ in outputs]
+    encoded = [i for i, (copy_video, _) in enumerate(plans) if not copy_video]
+
+    filter_parts = []
+    if encoded:
+        split_labels = "".join(f"[s{i}]" for i in encoded)
+        filter_parts.append(f"[0:v:0]split={len(encoded)}{split_labels}" if len(encoded) > 1 else f"[0:v:0]null{split_labels}")
+        for i in encoded:
+            filter_parts.append(f"[s{i}]{get_video_filter(outputs[i][0]) or 'null'}[v{i}]")
+    filter_flag = f'-filter_complex "{";".join(filter_parts)}"' if filter_parts else ""
+
+    temp_paths = [output_path + ".tmp" for _, output_path in outputs]
+    output_args = []
+    for i, ((target_ratio, _), (copy_video, copy_audio)) in enumerate(zip(outputs, plans)):
+        video_flags = "-map 0:v:0 -c:v copy" if copy_video else f"-map [v{i}] {get_video_flags()}"
+        audio_flags = ("-map 0:a:0 " + ("-c:a copy" if copy_audio else AUDIO_ENCODE_FLAGS)) if has_audio else ""
+        output_args.append(f'{video_flags} {audio_flags} {duration_flag} {threads_flag} -f mp4 "{temp_paths[i]}"')
+    progress_flag = "-progress pipe:1 -nostats " if metrics is not None else ""
+    ffmpeg_command = f'"{ffmpeg_path}" {progress_flag}-y -i "{input_path}" {filter_flag} ' + " ".join(output_args)
+
+    debug_print(f"Executing: {ffmpeg_command}")
+    success, output = run_encode(ffmpeg_command, os.path.basename(input_path), probe, duration, metrics)
+    if success:
+        for temp_output_path, (target_ratio, output_path) in zip(temp_paths, outputs):
+            os.replace(temp_output_path, output_path)
+            debug_print(f"Saved {target_ratio or 'source'} rendition as {output_path.replace(os.sep, '/')}")
+        return True
+    logger.error(f"Rendition conversion failed for {input_path}: {output}")
+    for temp_output_path in temp_paths:
+        if os.path.exists(temp_output_path):
+            os.remove(temp_output_path)
+            debug_print(f"Removed failed temp file: {temp_output_path}")
+    return False
+
+EXCLUDED_DIRS = {'converted_videos', 'converted_pictures', 'converted', 'converted_one_to_one', 'converted_nine_sixteen'}
+O_NUMBER_PATTERN = re.compile(r'O(\d+)\.')
+
+def o_number_key(name):
+    match = O_NUMBER_PATTERN.match(name)
+    return int(match.group(1)) if match else float('inf')
+
+def scan_files(directory, extensions):
+    # Depth-first like os.walk, but output folders are pruned before they are entered
+    extensions = tuple(ext.lower() for ext in extensions)
+    stack = [directory]
+    while stack:
+        root = stack.pop()
+        try:
+            with os.scandir(root) as it:
+                entries = sorted(it, key=lambda entry: (o_number_key(entry.name), entry.name))
+        except OSError as e:
+            logger.warning(f"Could not scan {root}: {e}")
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name in EXCLUDED_DIRS:
+                    debug_print(f"Excluded directory: {entry.path}")
                 else:
-                    debug_print(f"Excluded file (in subdir): {file_path}")
-        debug_print(f"Scanned {root}, found {len(filenames)} files, included {len(files)} valid files")
-    try:
-        return sorted(files, key=lambda x: int(re.match(r'O(\d+)\.', os.path.basename(x)).group(1)) if re.match(r'O(\d+)\.', os.path.basename(x)) else float('inf'))
-    except Exception as e:
-        debug_print(f"Sorting error: {e}. Falling back to alphabetical sort.")
-        return sorted(files)
+                    subdirs.append(entry.path)
+            elif entry.name.lower().endswith(extensions):
+                debug_print(f"Included file: {entry.path}")
+                yield entry.path
+        stack.extend(reversed(subdirs))
 
-def get_next_available_name(output_dir, prefix, file_type, start_number=1, duration=None):
-    number = start_number
+def get_files_recursive(directory, extensions, sort_numeric=False):
+    # Yields files as they are found; sort_numeric scans the whole tree first to order by O<n>
+    files = scan_files(directory, extensions)
+    if sort_numeric:
+        return iter(sorted(files, key=lambda path: o_number_key(os.path.basename(path))))
+    return files
+
+_used_numbers = {}
+
+def get_next_available_name(output_dir, prefix, file_type, start_number=1, duration=None, extension=None):
+    # Lists output_dir once per name pattern, then reserves each name with an exclusive create
+    # so parallel workers and other Convert runs never hand out the same file
     duration_suffix = f"_{duration}s" if duration is not None else "_full"
+    if file_type == "image":
+        head, tail = f"{prefix}_Pic_", extension or ".jpg"
+    else:
+        head, tail = f"{prefix}_Uni_", f"{duration_suffix}{extension or '.mp4'}"
+    key = (os.path.abspath(output_dir), head, tail)
+    if key not in _used_numbers:
+        pattern = re.compile(rf"{re.escape(head)}(\d+){re.escape(tail)}")
+        used = set()
+        try:
+            with os.scandir(output_dir) as it:
+                for entry in it:
+                    match = pattern.fullmatch(entry.name)
+                    if match:
+                        used.add(int(match.group(1)))
+        except FileNotFoundError:
+            pass
+        _used_numbers[key] = used
+        debug_print(f"Indexed {len(used)} existing {head}*{tail} names in {output_dir}")
+    used = _used_numbers[key]
+    number = start_number
     while True:
-        if file_type == "image":
-            name = f"{prefix}_Pic_{number}.jpg"
-        else:
-            name = f"{prefix}_Uni_{number}{duration_suffix}.mp4"
+        while number in used:
+            number += 1
+        used.add(number)
+        name = f"{head}{number}{tail}"
         full_path = os.path.join(output_dir, name)
-        debug_print(f"Checking output path: {full_path}")
-        if not os.path.exists(full_path):
-            debug_print(f"Available name: {full_path}")
-            return name, full_path, number + 1
-        number += 1
+        try:
+            os.close(os.open(full_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+        except FileExistsError:
+            debug_print(f"Name taken by another process: {full_path}")
+            continue
+        debug_print(f"Available name: {full_path}")
+        return name, full_path, number + 1
+
+def release_name(full_path):
+    # Remove the empty placeholder left by get_next_available_name when nothing was written
+    try:
+        if os.path.getsize(full_path) == 0:
+            os.remove(full_path)
+    except OSError:
+        pass
 
-def log_conversion(input_path, output_path, output_dir, duration=None):
+_conversion_stores = {}
+
+def import_json_log(conn, output_dir):
+    # One-time import of the legacy conversion_log.json; the imported table makes it safe to race
     log_file = os.path.join(output_dir, "conversion_log.json")
-    entry = {
-        "input_path": input_path,
-        "output_path": output_path,
-        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
-        "duration": duration,
-        "type": "image" if output_path.lower().endswith(".jpg") else "video"
-    }
-    if os.path.exists(log_file):
+    if not os.path.exists(log_file):
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT 1 FROM imported WHERE log_file = ?", (log_file,)).fetchone():
+            conn.execute("COMMIT")
+            return
         with open(log_file, 'r') as f:
             try:
                 log_data = json.load(f)
             except json.JSONDecodeError:
+                logger.warning("Error reading conversion_log.json, skipping import")
                 log_data = []
+        rows = [
+            (entry["input_path"], entry["output_path"], entry.get("timestamp"), entry.get("duration"), entry["type"])
+            for entry in log_data if "input_path" in entry and "output_path" in entry and "type" in entry
+        ]
+        conn.executemany("INSERT INTO conversions (input_path, output_path, timestamp, duration, type) VALUES (?, ?, ?, ?, ?)", rows)
+        conn.execute("INSERT INTO imported (log_file) VALUES (?)", (log_file,))
+        conn.execute("COMMIT")
+        logger.info(f"Imported {len(rows)} entries from {log_file}")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def get_conversion_store(output_dir):
+    db_path = os.path.join(output_dir, "conversion_log.db")
+    conn = _conversion_stores.get(db_path)
+    if conn is None:
+        os.makedirs(output_dir, exist_ok=True)
+        conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        # Rollback journal rather than WAL: output dirs are often on network shares, where WAL's shared memory is unsafe
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversions (input_path TEXT NOT NULL, output_path TEXT NOT NULL, timestamp TEXT, duration INTEGER, type TEXT NOT NULL, "
+            "size INTEGER, fingerprint TEXT, rendition TEXT)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_conversions_key ON conversions (input_path, duration, type)")
+        conn.execute("CREATE TABLE IF NOT EXISTS imported (log_file TEXT PRIMARY KEY)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_conversions_size ON conversions (size, duration, type)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_conversions_fingerprint ON conversions (fingerprint, duration, type)")
+        conn.execute("CREATE TABLE IF NOT EXISTS fingerprints (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, fingerprint TEXT)")
+        import_json_log(conn, output_dir)
+        _conversion_stores[db_path] = conn
+        debug_print(f"Opened conversion store: {db_path}")
+    return conn
+
+def get_file_fingerprint(conn, file_path, stat=None):
+    # Cached by (path, size, mtime) so unchanged files are never read twice
+    abs_path = os.path.abspath(file_path)
+    stat = stat or os.stat(abs_path)
+    row = conn.execute("SELECT size, mtime_ns, fingerprint FROM fingerprints WHERE path = ?", (abs_path,)).fetchone()
+    if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+        return row[2]
+    fingerprint = get_file_hash(abs_path)
+    if fingerprint:
+        conn.execute(
+            "INSERT OR REPLACE INTO fingerprints (path, size, mtime_ns, fingerprint) VALUES (?, ?, ?, ?)",
+            (abs_path, stat.st_size, stat.st_mtime_ns, fingerprint),
+        )
+        debug_print(f"Fingerprinted {file_path}: {fingerprint}")
+    return fingerprint
+
+IMAGE_OUTPUT_EXTENSIONS = tuple(ext for _, ext in IMAGE_FORMATS.values())
+
+def log_conversion(input_path, output_path, output_dir, duration=None, rendition=None):
+    conn = get_conversion_store(output_dir)
+    try:
+        stat = os.stat(input_path)
+        size, fingerprint = stat.st_size, get_file_fingerprint(conn, input_path, stat)
+    except OSError:
+        size, fingerprint = None, None
+    conn.execute(
+        "INSERT INTO conversions (input_path, output_path, timestamp, duration, type, size, fingerprint, rendition) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            input_path,
+            output_path,
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
+            duration,
+            "image" if output_path.lower().endswith(IMAGE_OUTPUT_EXTENSIONS) else "video",
+            size,
+            fingerprint,
+            rendition,
+        ),
+    )
+
+def get_existing_conversion(input_path, output_dir, prefix, file_type, duration=None, rendition=None):
+    conn = get_conversion_store(output_dir)
+    try:
+        stat = os.stat(input_path)
+    except OSError:
+        stat = None
+    row = conn.execute(
+        "SELECT rowid, output_path, fingerprint FROM conversions WHERE input_path = ? AND duration IS ? AND type = ? AND rendition IS ? ORDER BY rowid LIMIT 1",
+        (input_path, duration, file_type, rendition),
+    ).fetchone()
+    if row:
+        if row[2] is None and stat:
+            # Backfill entries imported from the JSON log so later moves are detected too
+            conn.execute("UPDATE conversions SET size = ?, fingerprint = ? WHERE rowid = ?", (stat.st_size, get_file_fingerprint(conn, input_path, stat), row[0]))
+        return row[1]
+    if not stat:
+        return None
+    # Moved or renamed input: only hash when a previous conversion has the same size
+    if not conn.execute(
+        "SELECT 1 FROM conversions WHERE size = ? AND duration IS ? AND type = ? AND rendition IS ? LIMIT 1",
+        (stat.st_size, duration, file_type, rendition),
+    ).fetchone():
+        return None
+    fingerprint = get_file_fingerprint(conn, input_path, stat)
+    if not fingerprint:
+        return None
+    row = conn.execute(
+        "SELECT output_path FROM conversions WHERE fingerprint = ? AND duration IS ? AND type = ? AND rendition IS ? ORDER BY rowid LIMIT 1",
+        (fingerprint, duration, file_type, rendition),
+    ).fetchone()
+    if row:
+        debug_print(f"Matched {input_path} by fingerprint {fingerprint}")
+    return row[0] if row else None
+
+def avif_supported():
+    if pillow_avif is not None:
+        return True
+    try:
+        return bool(features.check("avif"))
+    except ValueError:
+        return False
+
+RENDITIONS = {
+    "source": (None, "converted_videos"),
+    "9:16": ("9:16", "converted_nine_sixteen"),
+    "1:1": ("1:1", "converted_one_to_one"),
+}
+
+def parse_renditions(value):
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    unknown = [name for name in names if name not in RENDITIONS]
+    if unknown or not names:
+        raise argparse.ArgumentTypeError(f"Unknown rendition(s) {unknown}. Choose from {', '.join(RENDITIONS)}")
+    return list(dict.fromkeys(names))
+
+def convert_file(file_path, outputs, file_type, duration, settings):
+    # outputs is a list of (rendition, target_ratio, output_path)
+    start_time = time.perf_counter()
+    if file_type == "video" and len(outputs) > 1:
+        logger.info(f"Attempting to convert video: {file_path} ({', '.join(rendition for rendition, _, _ in outputs)})")
+        success = convert_video_renditions(file_path, [(target_ratio, output_path) for _, target_ratio, output_path in outputs], duration=duration, threads=settings["threads"], stream_copy=settings["stream_copy"], metrics=settings["metrics"])
+    elif file_type == "video":
+        _, target_ratio, output_path = outputs[0]
+        logger.info(f"Attempting to convert video: {file_path}")
+        success = convert_video(file_path, output_path, target_ratio=target_ratio, duration=duration, threads=settings["threads"], stream_copy=settings["stream_copy"], metrics=settings["metrics"], chunking=settings["chunking"])
     else:
-        log_data = []
-    log_data.append(entry)
-    with open(log_file, 'w') as f:
-        json.dump(log_data, f, indent=4)
+        _, target_ratio, output_path = outputs[0]
+        logger.info(f"Attempting to convert image: {file_path}")
+        success = convert_image(
+            file_path, output_path, target_ratio=target_ratio, crop=settings["crop"],
+            image_format=settings["image_format"], quality=settings["quality"],
+            max_size=settings["max_size"], target_kb=settings["target_kb"],
+        )
+    return success, time.perf_counter() - start_time
 
-def get_existing_conversion(input_path, output_dir, prefix, file_type, duration=None):
-    log_file = os.path.join(output_dir, "conversion_log.json")
-    if os.path.exists(log_file):
-        with open(log_file, 'r') as f:
-            try:
-                log_data = json.load(f)
-                for entry in log_data:
-                    if entry["input_path"] == input_path and entry.get("duration") == duration and entry["type"] == file_type:
-                        return entry["output_path"]
-            except json.JSONDecodeError:
-                logger.warning("Error reading conversion_log.json")
-    return None
+def finish_conversion(file_path, outputs, output_dir, file_type, result, stats, duration=None):
+    # Called from the main thread only; the store connection is not shared across threads
+    success, elapsed = result
+    if success:
+        for rendition, _, output_path in outputs:
+            log_conversion(file_path, output_path, output_dir, duration=duration, rendition=None if rendition == "source" else rendition)
+        if file_type == "image":
+            output_path = outputs[0][2]
+            size = os.path.getsize(output_path)
+            stats["images"] += 1
+            stats["image_bytes"] += size
+            stats["image_seconds"] += elapsed
+            logger.info(f"Converted image {os.path.basename(output_path)}: {size / 1024:.0f} KB in {elapsed:.2f}s")
+    else:
+        for _, _, output_path in outputs:
+            release_name(output_path)
+        logger.error(f"Failed to convert {file_type}: {file_path}")
+
+def drain_pending(pending, output_dir, stats, block=False, limit=None):
+    # Log finished jobs in submission order; with block=False stop at the first one still running,
+    # unless limit or more jobs are queued, then wait so the scan does not run far ahead of the workers
+    while pending and (block or pending[0][-1].done() or (limit is not None and len(pending) >= limit)):
+        # Only pop once the result is in, so a Ctrl-C while waiting leaves the job for the cleanup drain
+        file_path, outputs, file_type, duration, future = pending[0]
+        if future.cancelled():
+            pending.popleft()
+            for _, _, output_path in outputs:
+                release_name(output_path)
+            logger.info(f"Cancelled: {file_path}")
+            continue
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error(f"Worker error for {file_path}: {e}")
+            result = (False, 0.0)
+        pending.popleft()
+        finish_conversion(file_path, outputs, output_dir, file_type, result, stats, duration=duration)
+
+def report_image_stats(stats):
+    if not stats["images"]:
+        return
+    logger.info(
+        f"Images: {stats['images']} converted, {stats['images'] / max(stats['image_seconds'], 1e-6):.1f} images/s per worker, "
+        f"{stats['image_bytes'] / stats['images'] / 1024:.0f} KB average output"
+    )
 
 def main():
     parser = argparse.ArgumentParser(description="Convert videos and images to standard formats with prefix-based renaming")
@@ -280,6 +998,20 @@ def main():
     parser.add_argument("--nine_sixteen", action="store_true", help="Force 9:16 aspect ratio")
     parser.add_argument("--crop", action="store_true", help="Crop images to fit target aspect ratio")
     parser.add_argument("--t", type=int, default=None, help="Limit output video duration in seconds (default: process entire video)")
+    parser.add_argument("--renditions", type=parse_renditions, default=None, help="Comma-separated video renditions to encode from one decode: 9:16, 1:1, source (e.g., 9:16,1:1,source)")
+    parser.add_argument("--image-format", choices=sorted(IMAGE_FORMATS), default="jpeg", help="Output image format (default: jpeg)")
+    parser.add_argument("--quality", type=int, default=90, help="Image encoder quality, 1-100 (default: 90)")
+    parser.add_argument("--max-size", type=int, default=None, help="Downscale images so the longest side is at most this many pixels")
+    parser.add_argument("--target-kb", type=int, default=None, help="Pick the highest image quality that keeps each output under this size in KB")
+    parser.add_argument("--no-stream-copy", action="store_true", help="Always re-encode videos, even when streams already match the output profile")
+    parser.add_argument("--sort-numeric", action="store_true", help="Scan the whole tree first and process files in O<n> numeric order")
+    parser.add_argument("--progress", action="store_true", help="Show live encode progress and save a metrics summary to conversion_metrics.jsonl")
+    parser.add_argument("--stall-timeout", type=int, default=60, help="With --progress, stop an encode whose output has not advanced for this many seconds (default: 60)")
+    parser.add_argument("--chunk-threshold", type=int, default=None, help="Split videos longer than this many seconds at keyframes and encode the chunks in parallel")
+    parser.add_argument("--chunk-seconds", type=int, default=120, help="Target chunk length in seconds for --chunk-threshold (default: 120)")
+    parser.add_argument("--chunk-jobs", type=int, default=None, help="Chunks encoded at once per video (default: x264 threads per job / 4)")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of files to convert in parallel (default: 1)")
+    parser.add_argument("--threads", type=int, default=None, help="x264 threads per job (default: CPU count / jobs when --jobs > 1)")
     args = parser.parse_args()
     global DEBUG
     DEBUG = args.debug
@@ -299,57 +1031,118 @@ def main():
     image_extensions = ['.webp', '.png', '.jpg']
     extensions = video_extensions if args.v and not args.p else image_extensions if args.p and not args.v else video_extensions + image_extensions
 
-    image_count = 1
-    video_count = 1
-    for input_path in input_paths:
-        if not os.path.exists(input_path):
-            logger.error(f"Path {input_path} does not exist")
-            continue
+    image_format = args.image_format
+    if image_format == "avif" and not avif_supported():
+        logger.warning("AVIF encoding is not available in this Pillow build. Falling back to WebP")
+        image_format = "webp"
+    jobs = max(1, args.jobs)
+    threads = args.threads if args.threads else (max(1, (os.cpu_count() or 1) // jobs) if jobs > 1 else None)
+    settings = {
+        "target_ratio": "9:16" if args.nine_sixteen else "1:1" if args.one_to_one else None,
+        "crop": args.crop,
+        "threads": threads,
+        "stream_copy": not args.no_stream_copy,
+        "image_format": image_format,
+        "quality": args.quality,
+        "max_size": args.max_size,
+        "target_kb": args.target_kb,
+        "metrics": new_run_metrics(args.stall_timeout) if args.progress else None,
+        "chunking": {"threshold": args.chunk_threshold, "seconds": args.chunk_seconds, "jobs": args.chunk_jobs} if args.chunk_threshold else None,
+    }
+    stats = {"images": 0, "image_bytes": 0, "image_seconds": 0.0}
+    executor = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    pending = deque()
+    if executor:
+        logger.info(f"Converting with {jobs} parallel jobs ({threads} x264 threads per job)")
 
-        if os.path.isfile(input_path):
-            files = [input_path] if any(input_path.lower().endswith(ext) for ext in extensions) else []
-            logger.info(f"Processing file: {input_path}")
-        else:
-            files = get_files_recursive(input_path, extensions)
-            if not files:
-                logger.error(f"No files found in {input_path} with extensions {extensions}")
-                continue
-            logger.info(f"Processing directory: {input_path}")
-
-        for i, file_path in enumerate(files, 1):
-            logger.info(f"Checking {file_path} ({i}/{len(files)})")
-            _, ext = os.path.splitext(file_path)
-            is_video = file_path.lower().endswith(tuple(video_extensions))
-            output_subdir = os.path.join(output_dir, "converted_videos" if is_video else "converted_pictures")
-            os.makedirs(output_subdir, exist_ok=True)
-            debug_print(f"Created output directory: {output_subdir}")
-
-            file_type = "video" if is_video else "image"
-            existing_output = get_existing_conversion(file_path, output_dir, prefix, file_type, duration=args.t)
-            if existing_output and os.path.exists(existing_output):
-                logger.info(f"Skipping {file_path}: already converted to {existing_output}")
+    counters = {}
+    outputs = []
+    try:
+        for input_path in input_paths:
+            if not os.path.exists(input_path):
+                logger.error(f"Path {input_path} does not exist")
                 continue
 
-            if not os.path.exists(file_path):
-                logger.warning(f"Skipping {file_path}: source file does not exist")
-                continue
+            if os.path.isfile(input_path):
+                files = iter([input_path] if any(input_path.lower().endswith(ext) for ext in extensions) else [])
+                logger.info(f"Processing file: {input_path}")
+            else:
+                files = get_files_recursive(input_path, extensions, sort_numeric=args.sort_numeric)
+                logger.info(f"Processing directory: {input_path}")
+
+            found = False
+            for i, file_path in enumerate(files, 1):
+                found = True
+                logger.info(f"Checking {file_path} ({i})")
+                is_video = file_path.lower().endswith(tuple(video_extensions))
+                file_type = "video" if is_video else "image"
+                if is_video and (not args.p or args.v):
+                    duration = args.t
+                    if args.renditions:
+                        targets = [(name,) + RENDITIONS[name] for name in args.renditions]
+                    else:
+                        targets = [("source", settings["target_ratio"], "converted_videos")]
+                    extension = ".mp4"
+                elif not is_video and (not args.v or args.p):
+                    duration = None
+                    targets = [("source", settings["target_ratio"], "converted_pictures")]
+                    extension = IMAGE_FORMATS[image_format][1]
+                else:
+                    continue
+
+                missing = []
+                for rendition, target_ratio, subdir in targets:
+                    log_rendition = None if rendition == "source" else rendition
+                    existing_output = get_existing_conversion(file_path, output_dir, prefix, file_type, duration=duration, rendition=log_rendition)
+                    if existing_output and os.path.exists(existing_output):
+                        logger.info(f"Skipping {file_path}{'' if log_rendition is None else f' ({rendition})'}: already converted to {existing_output}")
+                    else:
+                        missing.append((rendition, target_ratio, subdir))
+                if not missing:
+                    continue
+
+                if not os.path.exists(file_path):
+                    logger.warning(f"Skipping {file_path}: source file does not exist")
+                    continue
+
+                outputs = []
+                for rendition, target_ratio, subdir in missing:
+                    output_subdir = os.path.join(output_dir, subdir)
+                    os.makedirs(output_subdir, exist_ok=True)
+                    name, output_path, counters[output_subdir] = get_next_available_name(
+                        output_subdir, prefix, file_type, start_number=counters.get(output_subdir, 1), duration=duration, extension=extension
+                    )
+                    outputs.append((rendition, target_ratio, output_path))
+
+                if executor:
+                    pending.append((file_path, outputs, file_type, duration, executor.submit(convert_file, file_path, outputs, file_type, duration, settings)))
+                    drain_pending(pending, output_dir, stats, limit=2 * jobs)
+                else:
+                    result = convert_file(file_path, outputs, file_type, duration, settings)
+                    finish_conversion(file_path, outputs, output_dir, file_type, result, stats, duration=duration)
+
+            if not found:
+                logger.error(f"No files found in {input_path} with extensions {extensions}")
 
-            if is_video and (not args.p or args.v):
-                name, output_path, video_count = get_next_available_name(output_subdir, prefix, "video", start_number=video_count, duration=args.t)
-                logger.info(f"Attempting to convert video: {file_path}")
-                success = convert_video(file_path, output_path, target_ratio="9:16" if args.nine_sixteen else "1:1" if args.one_to_one else None, duration=args.t)
-                if success:
-                    log_conversion(file_path, output_path, output_dir, duration=args.t)
-                if not success:
-                    logger.error(f"Failed to convert video: {file_path}")
-            elif not is_video and (not args.v or args.p):
-                name, output_path, image_count = get_next_available_name(output_subdir, prefix, "image", start_number=image_count, duration=None)
-                logger.info(f"Attempting to convert image: {file_path}")
-                success = convert_image(file_path, output_path, target_ratio="9:16" if args.nine_sixteen else "1:1" if args.one_to_one else None, crop=args.crop)
-                if success:
-                    log_conversion(file_path, output_path, output_dir, duration=None)
-                if not success:
-                    logger.error(f"Failed to convert image: {file_path}")
+        if executor:
+            drain_pending(pending, output_dir, stats, block=True)
+    except KeyboardInterrupt:
+        logger.warning("Interrupted, cancelling queued conversions")
+        # Names reserved for the file being converted or queued when Ctrl-C arrived; finished outputs are not empty and stay
+        for _, _, output_path in outputs:
+            release_name(output_path)
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+            terminate_active_processes()
+            executor.shutdown(wait=True)
+            drain_pending(pending, output_dir, stats, block=True)
+        raise
+    finally:
+        if executor:
+            executor.shutdown(wait=True)
+    report_image_stats(stats)
+    if settings["metrics"] is not None and settings["metrics"]["files"]:
+        write_run_metrics(settings["metrics"], output_dir)
 
 if __name__ == "__main__":
     main()
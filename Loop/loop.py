@@ -3,6 +3,7 @@ import sys
 import os
 import argparse
 import time
+import re
 import shutil
 
 DEBUG = False
@@ -58,19 +59,51 @@ def sanitize_filename(filename):
     sanitized = re.sub(invalid_chars, '', filename.strip()).strip('[]{}()').rstrip('.').lstrip('._')[:200]
     return sanitized or '_'
 
+_used_numbers = {}
+
 def get_next_available_name(output_dir, prefix, extension, suffix="", title=None, start_number=1):
+    # Lists output_dir once per name pattern, then reserves each name with an exclusive create
+    # so concurrent runs writing to the same folder never pick the same file
     sanitized_title = sanitize_filename(title) if title else None
+    title_part = f"_{sanitized_title}" if sanitized_title else ""
+    key = (os.path.abspath(output_dir), prefix, title_part, suffix, extension)
+    if key not in _used_numbers:
+        patterns = [
+            re.compile(rf"{re.escape(prefix)}_(\d+){re.escape(title_part + suffix + extension)}"),
+            re.compile(rf"{re.escape(prefix)}_(\d+){re.escape(title_part)}_thumb\.webp"),
+        ]
+        used = set()
+        try:
+            with os.scandir(output_dir) as it:
+                for entry in it:
+                    for pattern in patterns:
+                        match = pattern.fullmatch(entry.name)
+                        if match:
+                            used.add(int(match.group(1)))
+        except FileNotFoundError:
+            pass
+        _used_numbers[key] = used
+    used = _used_numbers[key]
     number = start_number
     while True:
-        if sanitized_title:
-            name = f"{prefix}_{number}_{sanitized_title}{suffix}{extension}"
-        else:
-            name = f"{prefix}_{number}{suffix}{extension}"
+        while number in used:
+            number += 1
+        used.add(number)
+        name = f"{prefix}_{number}{title_part}{suffix}{extension}"
         full_path = os.path.join(output_dir, name)
-        thumb_path = os.path.join(output_dir, f"{prefix}_{number}{'_'+sanitized_title if sanitized_title else ''}_thumb.webp")
-        if not os.path.exists(full_path) and not os.path.exists(thumb_path):
-            return name, full_path, number + 1
-        number += 1
+        try:
+            os.close(os.open(full_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+        except FileExistsError:
+            continue
+        return name, full_path, number + 1
+
+def release_name(full_path):
+    # Remove the empty placeholder left by get_next_available_name when nothing was written
+    try:
+        if os.path.getsize(full_path) == 0:
+            os.remove(full_path)
+    except OSError:
+        pass
 
 def get_file_duration(file_path):
     command = f'ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 "{file_path}"'
@@ -208,7 +241,7 @@ def main():
             loop_duration = duration
             if loop_duration <= trim_duration:
                 print(f"Warning: Duration {loop_duration} <= trim duration {trim_duration}. No looping")
-                os.rename(f"{temp_path}{extension}", output_path)
+                os.replace(f"{temp_path}{extension}", output_path)
                 print(f"Saved {'audio' if output_type == 'a' else 'video'} as {output_path.replace(os.sep, '/')}")
             else:
                 loop_count = int(loop_duration // trim_duration) + (1 if loop_duration % trim_duration > 0 else 0)
@@ -226,9 +259,10 @@ def main():
                 if os.path.exists(f"{temp_path}{extension}"):
                     os.remove(f"{temp_path}{extension}")
         else:
-            os.rename(f"{temp_path}{extension}", output_path)
+            os.replace(f"{temp_path}{extension}", output_path)
             print(f"Saved {'audio' if output_type == 'a' else 'video'} as {output_path.replace(os.sep, '/')}")
     finally:
+        release_name(output_path)
         if os.path.exists(temp_dir):
             shutil.rmtree(temp_dir, ignore_errors=True)
 
@@ -3,10 +3,18 @@ import sys
 import os
 import argparse
 import glob
+import json
 import re
 import time
+import threading
 from PIL import Image
 import shutil
+import hashlib
+import tempfile
+import signal
+import math
+from fractions import Fraction
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 DEBUG = False
 
@@ -14,13 +22,41 @@ def debug_print(*args, **kwargs):
     if DEBUG:
         print(*args, **kwargs)
 
+_active_processes = set()
+_process_lock = threading.Lock()
+_stopping = False
+
+def kill_process_tree(process):
+    # shell=True puts ffmpeg under a shell, so kill the whole group rather than just the shell
+    if os.name == "nt":
+        subprocess.run(f"taskkill /F /T /PID {process.pid}", shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    else:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+def terminate_active_processes():
+    # Stops every running ffmpeg and keeps new ones from starting, so queued slides end right away
+    global _stopping
+    with _process_lock:
+        _stopping = True
+        processes = list(_active_processes)
+    for process in processes:
+        if process.poll() is None:
+            kill_process_tree(process)
+
 def run_command(command, suppress_errors=False, timeout=None, retries=1):
     attempt = 0
     while attempt <= retries:
         debug_print(f"Running command (Attempt {attempt+1}/{retries+1}): {command}")
         stdout = subprocess.PIPE if not suppress_errors else subprocess.DEVNULL
         stderr = subprocess.PIPE if not suppress_errors else subprocess.DEVNULL
-        process = subprocess.Popen(command, shell=True, stdout=stdout, stderr=stderr, text=True)
+        with _process_lock:
+            if _stopping:
+                return False, "Cancelled"
+            process = subprocess.Popen(command, shell=True, stdout=stdout, stderr=stderr, text=True, start_new_session=(os.name != "nt"))
+            _active_processes.add(process)
         output, errors = [], []
         try:
             stdout_data, stderr_data = process.communicate(timeout=timeout)
@@ -40,7 +76,7 @@ def run_command(command, suppress_errors=False, timeout=None, retries=1):
                 return False, output_str + "\n" + error_str
             return True, output_str
         except subprocess.TimeoutExpired:
-            process.kill()
+            kill_process_tree(process)
             attempt += 1
             if attempt <= retries:
                 debug_print(f"Timeout after {timeout}s. Retrying {attempt}/{retries}")
@@ -49,30 +85,110 @@ def run_command(command, suppress_errors=False, timeout=None, retries=1):
             debug_print(f"Timeout after {timeout}s. No more retries")
             return False, f"Timeout after {timeout}s"
         except Exception as ex:
-            process.kill()
+            kill_process_tree(process)
             debug_print(f"Error: {ex}")
             return False, str(ex)
         finally:
+            # Also reached on Ctrl-C: ffmpeg runs in its own process group and would not see the signal
             if process.poll() is None:
-                process.terminate()
+                kill_process_tree(process)
+            with _process_lock:
+                _active_processes.discard(process)
+
+_used_numbers = {}
 
-def get_next_available_name(output_dir, start_number=1):
+def get_next_available_name(output_dir, start_number=1, prefix="S"):
+    # Lists output_dir once per prefix, then reserves each name with an exclusive create
+    # so concurrent runs writing to the same folder never pick the same file
+    key = (os.path.abspath(output_dir), prefix)
+    if key not in _used_numbers:
+        pattern = re.compile(rf"{re.escape(prefix)}_(\d+)\.mp4")
+        used = set()
+        try:
+            with os.scandir(output_dir) as it:
+                for entry in it:
+                    match = pattern.fullmatch(entry.name)
+                    if match:
+                        used.add(int(match.group(1)))
+        except FileNotFoundError:
+            pass
+        _used_numbers[key] = used
+    used = _used_numbers[key]
     number = start_number
     while True:
-        name = f"S_{number}{'.mp4'}"
+        while number in used:
+            number += 1
+        used.add(number)
+        name = f"{prefix}_{number}.mp4"
         full_path = os.path.join(output_dir, name)
-        if not os.path.exists(full_path):
-            return name, full_path, number + 1
-        number += 1
+        try:
+            os.close(os.open(full_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+        except FileExistsError:
+            continue
+        return name, full_path, number + 1
+
+def release_name(full_path):
+    # Remove the empty placeholder left by get_next_available_name when nothing was written
+    try:
+        if os.path.getsize(full_path) == 0:
+            os.remove(full_path)
+    except OSError:
+        pass
+
+DIMENSION_CACHE_FILE = "dimensions.json"
+_dimension_cache = {}
+_dimension_lock = threading.Lock()
+
+def load_dimension_cache(cache_dir):
+    # Dimensions from earlier runs: absolute path -> [size, mtime_ns, width, height]
+    cache_file = os.path.join(cache_dir, DIMENSION_CACHE_FILE)
+    try:
+        with open(cache_file, "r") as f:
+            _dimension_cache.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError):
+        debug_print(f"Ignoring unreadable dimension cache {cache_file}")
+
+def save_dimension_cache(cache_dir):
+    cache_file = os.path.join(cache_dir, DIMENSION_CACHE_FILE)
+    temp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with _dimension_lock:
+        with open(temp_file, "w") as f:
+            json.dump(_dimension_cache, f)
+    os.replace(temp_file, cache_file)
 
 def get_image_dimensions(image_path):
+    # Image.open only parses the header; the result is reused while the file's size and mtime are unchanged
     try:
+        stat = os.stat(image_path)
+        key = os.path.abspath(image_path)
+        entry = _dimension_cache.get(key)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2], entry[3]
         with Image.open(image_path) as img:
-            return img.size
+            width, height = img.size
+        with _dimension_lock:
+            _dimension_cache[key] = [stat.st_size, stat.st_mtime_ns, width, height]
+        return width, height
     except Exception:
         print(f"Warning: Could not get dimensions for {image_path}. Using 1080x1080")
         return 1080, 1080
 
+_directory_index = {}
+
+def get_directory_index(directory, extensions):
+    # Lists each folder once per run: lowercased name without extension -> image paths with that name
+    if directory not in _directory_index:
+        index = {}
+        with os.scandir(directory) as it:
+            for entry in it:
+                file_base, file_ext = os.path.splitext(entry.name.lower())
+                if file_ext in extensions:
+                    index.setdefault(file_base, []).append(os.path.join(directory, entry.name))
+        _directory_index[directory] = index
+    return _directory_index[directory]
+
 def find_image_file(image_path):
     extensions = ['.jpg', '.jpeg', '.png', '.webp']
     image_path = os.path.abspath(image_path)
@@ -97,12 +213,7 @@ def find_image_file(image_path):
         debug_print(f"Directory does not exist: {directory}")
         return None
     try:
-        matched_files = []
-        for file in os.listdir(directory):
-            file_lower = file.lower()
-            file_base, file_ext = os.path.splitext(file_lower)
-            if file_base == base_name and file_ext in extensions:
-                matched_files.append(os.path.join(directory, file))
+        matched_files = get_directory_index(directory, extensions).get(base_name, [])
         if not matched_files:
             debug_print(f"No image found for '{base_name}' in '{directory}'")
             return None
@@ -120,7 +231,9 @@ def find_image_file(image_path):
         return None
 
 def determine_best_resolution(file_paths):
-    dimensions = [get_image_dimensions(file) for file in file_paths]
+    # Header reads are I/O bound, so they run in a thread pool
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as pool:
+        dimensions = list(pool.map(get_image_dimensions, file_paths))
     if not dimensions:
         print("Error: No valid dimensions found. Using 1920x1080")
         return 1920, 1080
@@ -191,6 +304,237 @@ def parse_image_names(names, folder_path):
     debug_print(f"Sorted image names: {names}")
     return names
 
+# Image formats the concat demuxer can only mix if they share a decoder
+IMAGE_CODECS = {'.jpg': 'mjpeg', '.jpeg': 'mjpeg', '.png': 'png', '.webp': 'webp'}
+
+PRESCALE_CACHE_VERSION = "1"
+
+def get_prescaled_path(cache_dir, image_path, width, height):
+    stat = os.stat(image_path)
+    key = hashlib.blake2b(
+        "|".join([PRESCALE_CACHE_VERSION, os.path.abspath(image_path), str(stat.st_size), str(stat.st_mtime_ns), f"{width}x{height}"]).encode(),
+        digest_size=16,
+    ).hexdigest()
+    return os.path.join(cache_dir, f"{key}.png")
+
+def prescale_image(image_path, cache_dir, width, height):
+    # Decodes the source once and writes a width x height frame, fitted and padded like the ffmpeg scale/pad filter,
+    # so ffmpeg never decodes or scales the full-resolution still for every output frame
+    try:
+        output_path = get_prescaled_path(cache_dir, image_path, width, height)
+        if os.path.exists(output_path):
+            os.utime(output_path)
+            return output_path
+        with Image.open(image_path) as img:
+            # JPEG decodes at a reduced scale (1/2, 1/4, 1/8) when that is still at least the target size
+            img.draft('RGB', (width, height))
+            scale = min(width / img.width, height / img.height)
+            fit_width = max(1, round(img.width * scale))
+            fit_height = max(1, round(img.height * scale))
+            img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+            img = img.resize((fit_width, fit_height), Image.LANCZOS, reducing_gap=3.0)
+            frame = Image.new('RGB', (width, height))
+            frame.paste(img, ((width - fit_width) // 2, (height - fit_height) // 2), img if img.mode == 'RGBA' else None)
+        temp_path = f"{output_path[:-4]}.{os.getpid()}.{threading.get_ident()}.partial.png"
+        frame.save(temp_path, compress_level=1)
+        os.replace(temp_path, output_path)
+        return output_path
+    except Exception as e:
+        print(f"Warning: Could not prescale {image_path}, ffmpeg will scale it: {e}")
+        return image_path
+
+def prescale_images(image_paths, cache_dir, width, height):
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+        return list(pool.map(lambda path: prescale_image(path, cache_dir, width, height), image_paths))
+
+def prune_prescale_cache(cache_dir, max_bytes, keep=()):
+    # Least recently used first; frames used by this run are never evicted
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(".png") and ".partial" not in entry.name:
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    keep = set(keep)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path in keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+            debug_print(f"Evicted prescaled image: {path}")
+        except OSError:
+            pass
+    debug_print(f"Prescale cache size: {total / 1048576:.1f} MB")
+
+def get_slide_durations(count, duration, durations_arg):
+    if not durations_arg:
+        return [duration] * count
+    try:
+        durations = [float(d) for d in durations_arg.split(',')]
+    except ValueError:
+        print(f"Error: Invalid --durations '{durations_arg}'. Use comma-separated seconds, e.g. 3,5,2.5")
+        sys.exit(1)
+    if len(durations) != count or any(d <= 0 for d in durations):
+        print(f"Error: --durations needs {count} positive values, got {len(durations)}")
+        sys.exit(1)
+    return durations
+
+STILL_CRF = 20
+
+def get_encode_flags(still_rate=None, gop_frames=None):
+    # In still mode a slide is a handful of identical frames: x264 is tuned for static pictures
+    # and a GOP covers the whole slide, so encode time barely depends on the duration
+    if still_rate:
+        return f"-c:v libx264 -preset fast -tune stillimage -crf {STILL_CRF} -g {gop_frames} -r {still_rate} -pix_fmt yuv420p "
+    return "-c:v libx264 -preset fast -b:v 3500k -r 30 -pix_fmt yuv420p "
+
+def get_still_timing(duration, still_fps):
+    # -t at a low rate rounds up to whole frames (2.5s at 1 fps gives 3s), so use a whole number of frames
+    # at no less than --still-fps and stretch the rate until they add up to exactly the duration
+    frames = max(1, math.ceil(duration * still_fps - 1e-9))
+    rate = (frames / Fraction(str(duration))).limit_denominator(10000)
+    return frames, f"{rate.numerator}/{rate.denominator}"
+
+MAX_STILL_RATE = 30
+
+def get_combined_still_rate(durations, still_fps, crossfade=0):
+    # One rate for the whole slideshow: the lowest multiple of a rate at which every duration (and the crossfade)
+    # is a whole number of frames, at no less than --still-fps, so slide boundaries land exactly on the requested times
+    step = None
+    for value in list(durations) + ([crossfade] if crossfade else []):
+        unit = 1 / Fraction(str(value))
+        step = unit if step is None else Fraction(math.lcm(step.numerator, unit.numerator), math.gcd(step.denominator, unit.denominator))
+    rate = step * math.ceil(Fraction(str(still_fps)) / step)
+    return rate, f"{rate.numerator}/{rate.denominator}"
+
+def build_slide_command(image_path, output_path, width, height, duration, still_fps=None):
+    if still_fps:
+        frames, still_rate = get_still_timing(duration, still_fps)
+        framerate_flag, length_flag = f"-framerate {still_rate} ", f"-frames:v {frames}"
+    else:
+        frames, still_rate = None, None
+        framerate_flag, length_flag = "", f"-t {duration}"
+    return (
+        f'ffmpeg -y -loop 1 {framerate_flag}-i "{image_path}" '
+        f'{get_encode_flags(still_rate, frames)}'
+        f'-vf "scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2" '
+        f'{length_flag} "{output_path}"'
+    )
+
+def get_slide_filter(width, height, rate="30"):
+    return (
+        f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+        f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,fps={rate},format=yuv420p"
+    )
+
+def write_concat_script(script_path, image_paths, durations):
+    # ffconcat script with a duration per image; the last image is listed twice so its duration is honoured
+    with open(script_path, "w") as f:
+        f.write("ffconcat version 1.0\n")
+        for image_path, duration in zip(image_paths, durations):
+            escaped = image_path.replace(os.sep, '/').replace("'", "'\\''")
+            f.write(f"file '{escaped}'\nduration {duration}\n")
+        escaped = image_paths[-1].replace(os.sep, '/').replace("'", "'\\''")
+        f.write(f"file '{escaped}'\n")
+
+def get_slide_boundaries(durations, crossfade=0):
+    # Start time of every slide after the first in the combined video; with crossfades a slide starts when its fade begins
+    boundaries = []
+    elapsed = 0.0
+    for i, duration in enumerate(durations[:-1]):
+        elapsed += duration - (crossfade if i > 0 else 0)
+        boundaries.append(round(elapsed - crossfade, 3))
+    return boundaries
+
+def render_slideshow(image_paths, durations, output_path, temp_dir, width, height, crossfade=0, still_rate=None):
+    # Renders every slide in one ffmpeg process, with keyframes on the slide boundaries so it can be split with stream copy.
+    # still_rate comes from get_combined_still_rate, so every slide is a whole number of frames
+    rate = still_rate or "30"
+    slide_filter = get_slide_filter(width, height, rate)
+    encode_flags = get_encode_flags(still_rate, max(1, math.ceil(max(durations) * Fraction(rate) - Fraction(1, 1000))))
+    boundaries = get_slide_boundaries(durations, crossfade)
+    keyframes_flag = f'-force_key_frames "{",".join(str(t) for t in boundaries)}" ' if boundaries else ""
+    codecs = {IMAGE_CODECS.get(os.path.splitext(p)[1].lower()) for p in image_paths}
+    if not crossfade and len(codecs) == 1:
+        script_path = os.path.join(temp_dir, "slides.txt")
+        write_concat_script(script_path, image_paths, durations)
+        ffmpeg_command = (
+            f'ffmpeg -y -f concat -safe 0 -i "{script_path}" '
+            f'-vf "{slide_filter}" '
+            f'{encode_flags}{keyframes_flag}'
+            f'"{output_path}"'
+        )
+    else:
+        # Mixed image formats or crossfades: one looped input per image, joined in a filter script
+        inputs = " ".join(f'-loop 1 -framerate {rate} -t {d} -i "{p}"' for p, d in zip(image_paths, durations))
+        chains = [f"[{i}:v]{slide_filter}[v{i}]" for i in range(len(image_paths))]
+        if crossfade and len(image_paths) > 1:
+            label, length = "v0", durations[0]
+            for i in range(1, len(image_paths)):
+                offset = length - crossfade
+                chains.append(f"[{label}][v{i}]xfade=transition=fade:duration={crossfade}:offset={offset:.3f}[x{i}]")
+                label, length = f"x{i}", length + durations[i] - crossfade
+            chains.append(f"[{label}]null[out]")
+        else:
+            chains.append("".join(f"[v{i}]" for i in range(len(image_paths))) + f"concat=n={len(image_paths)}:v=1:a=0[out]")
+        script_path = os.path.join(temp_dir, "slides_filter.txt")
+        with open(script_path, "w") as f:
+            f.write(";\n".join(chains))
+        ffmpeg_command = (
+            f'ffmpeg -y {inputs} -filter_complex_script "{script_path}" -map "[out]" '
+            f'{encode_flags}{keyframes_flag}'
+            f'"{output_path}"'
+        )
+    debug_print(f"FFmpeg command: {ffmpeg_command}")
+    success, output = run_command(ffmpeg_command)
+    return success and os.path.exists(output_path), output, boundaries
+
+def split_slideshow(combined_path, boundaries, temp_dir):
+    # Cuts the combined video on its forced keyframes without re-encoding; returns the parts in order
+    if not boundaries:
+        part_path = os.path.join(temp_dir, "part_00000.mp4")
+        shutil.copyfile(combined_path, part_path)
+        return [part_path]
+    ffmpeg_command = (
+        f'ffmpeg -y -i "{combined_path}" -map 0 -c copy -f segment '
+        f'-segment_times {",".join(str(t) for t in boundaries)} -reset_timestamps 1 '
+        f'"{os.path.join(temp_dir, "part_%05d.mp4")}"'
+    )
+    debug_print(f"FFmpeg command: {ffmpeg_command}")
+    success, output = run_command(ffmpeg_command)
+    parts = [os.path.join(temp_dir, f"part_{i:05d}.mp4") for i in range(len(boundaries) + 1)]
+    if not success or not all(os.path.exists(part) for part in parts):
+        debug_print(f"FFmpeg output: {output}")
+        return None
+    return parts
+
+def encode_slide(image_path, output_path, temp_dir, width, height, duration, still_fps=None):
+    # Encodes into the run's private temp folder and renames onto the reserved S_N name,
+    # so a partly written slide never appears under its final name
+    temp_output_path = os.path.join(temp_dir, f"{os.path.splitext(os.path.basename(output_path))[0]}.mp4")
+    ffmpeg_command = build_slide_command(image_path, temp_output_path, width, height, duration, still_fps)
+    debug_print(f"FFmpeg command: {ffmpeg_command}")
+    start_time = time.time()
+    success, output = run_command(ffmpeg_command)
+    elapsed = time.time() - start_time
+    if success and os.path.exists(temp_output_path):
+        os.replace(temp_output_path, output_path)
+        return True, output, elapsed
+    return False, output, elapsed
+
+def report_slide_timings(timings, wall_time, jobs):
+    # timings: (slide number, source image, encode seconds) in slide order
+    print(f"Encoded {len(timings)} slides in {wall_time:.1f}s with {jobs} job{'s' if jobs != 1 else ''}:")
+    for number, source_path, elapsed in timings:
+        print(f"  Slide {number} ({os.path.basename(source_path)}): {elapsed:.2f}s")
+    if timings:
+        total = sum(elapsed for _, _, elapsed in timings)
+        slowest = max(timings, key=lambda timing: timing[2])
+        print(f"  Total encode time {total:.1f}s, average {total / len(timings):.2f}s, slowest Slide {slowest[0]} ({slowest[2]:.2f}s)")
+
 def main():
     global DEBUG
     parser = argparse.ArgumentParser(description="Create slideshow from images")
@@ -199,6 +543,16 @@ def main():
     parser.add_argument("image_names", nargs='*', help="Image names or range")
     parser.add_argument("--output-dir", help="Output directory")
     parser.add_argument("--keep-original-resolution", action="store_true", help="Keep original image resolution")
+    parser.add_argument("--combined", action="store_true", help="Render all slides into one Slideshow_N.mp4 with a single ffmpeg process")
+    parser.add_argument("--durations", help="Comma-separated duration per image in seconds, overrides duration")
+    parser.add_argument("--crossfade", type=float, default=0, help="Crossfade between slides in seconds (with --combined)")
+    parser.add_argument("--split-slides", action="store_true", help="With --combined, also write every slide as S_N.mp4 by stream copy")
+    parser.add_argument("--still", action="store_true", help="Encode slides as a few frames tuned for still images instead of 30 fps at 3500k")
+    parser.add_argument("--still-fps", type=float, default=1, help="Frame rate in --still mode; use 30 where a platform needs constant 30 fps (default: 1)")
+    parser.add_argument("--cache-dir", help="Folder for prescaled images and cached image dimensions (default: <output-dir>/slide_cache)")
+    parser.add_argument("--cache-size", type=float, default=5, help="Maximum prescale cache size in GB, least recently used images are removed first (default: 5)")
+    parser.add_argument("--no-prescale", action="store_true", help="Let ffmpeg decode and scale the source images itself")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of slides to encode in parallel (default: 1)")
     parser.add_argument("--debug", action="store_true", help="Enable debug output")
     args = parser.parse_args()
     DEBUG = args.debug
@@ -208,6 +562,10 @@ def main():
     image_names = args.image_names
     output_dir = args.output_dir or os.path.abspath(folder_path)
     keep_original_resolution = args.keep_original_resolution
+    still_fps = args.still_fps if args.still else None
+    if still_fps is not None and still_fps <= 0:
+        print(f"Error: --still-fps must be positive, got {args.still_fps}")
+        sys.exit(1)
     if not os.path.isdir(folder_path):
         print(f"Error: Directory does not exist: {folder_path}")
         sys.exit(1)
@@ -227,40 +585,122 @@ def main():
         print(f"No images found in {folder_path}")
         sys.exit(1)
     debug_print(f"Found {len(actual_paths)} images")
+    cache_dir = os.path.abspath(args.cache_dir or os.path.join(output_dir, "slide_cache"))
+    os.makedirs(cache_dir, exist_ok=True)
+    load_dimension_cache(cache_dir)
+    start_time = time.time()
     target_width, target_height = determine_best_resolution(actual_paths)
+    save_dimension_cache(cache_dir)
+    debug_print(f"Read dimensions of {len(actual_paths)} images in {time.time() - start_time:.3f}s")
     debug_print(f"Target resolution: {target_width}x{target_height}")
-    temp_dir = os.path.abspath(os.path.join(".", "temp"))
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
+    # Private to this run and on the same drive as the outputs, so finished files are moved in with a rename
+    temp_dir = tempfile.mkdtemp(prefix=".slide_tmp_", dir=output_dir)
     try:
-        for i, image_path in enumerate(actual_paths, 1):
+        source_paths = actual_paths
+        if not args.no_prescale and (args.combined or not keep_original_resolution):
+            # Every slide shares the target size, so each image is decoded and scaled once up front
+            start_time = time.time()
+            actual_paths = prescale_images(actual_paths, cache_dir, target_width, target_height)
+            debug_print(f"Prescaled {len(actual_paths)} images to {target_width}x{target_height} in {time.time() - start_time:.2f}s")
+            prune_prescale_cache(cache_dir, int(args.cache_size * 1024 ** 3), keep=actual_paths)
+        if args.combined:
+            durations = get_slide_durations(len(actual_paths), duration, args.durations)
+            if args.crossfade and any(d <= args.crossfade for d in durations):
+                print(f"Error: --crossfade {args.crossfade} must be shorter than every slide duration")
+                sys.exit(1)
+            still_rate = None
+            if still_fps:
+                rate, still_rate = get_combined_still_rate(durations, still_fps, args.crossfade)
+                if rate > MAX_STILL_RATE:
+                    print(
+                        f"Error: --still needs {float(rate):g} fps for these durations to be whole frames. "
+                        f"Use durations (and --crossfade) in steps of 1/--still-fps seconds"
+                    )
+                    sys.exit(1)
+            if keep_original_resolution:
+                print(f"Warning: --keep-original-resolution is ignored with --combined, using {target_width}x{target_height}")
+            name, output_path, _ = get_next_available_name(output_dir, prefix="Slideshow")
+            temp_output_path = os.path.join(temp_dir, name)
+            try:
+                success, output, boundaries = render_slideshow(
+                    actual_paths, durations, temp_output_path, temp_dir, target_width, target_height, args.crossfade, still_rate,
+                )
+                if success:
+                    os.replace(temp_output_path, output_path)
+                else:
+                    print(f"Failed to render slideshow of {len(actual_paths)} images")
+                    debug_print(f"FFmpeg output: {output}")
+                    sys.exit(1)
+            finally:
+                # Also reached on Ctrl-C, so an empty placeholder never keeps the number
+                release_name(output_path)
+            print(f"Saved slideshow of {len(actual_paths)} slides as {output_path.replace(os.sep, '/')}")
+            if args.split_slides:
+                parts = split_slideshow(output_path, boundaries, temp_dir)
+                if parts is None:
+                    print(f"Failed to split {output_path} into slides")
+                    sys.exit(1)
+                for i, part in enumerate(parts, 1):
+                    name, slide_path, _ = get_next_available_name(output_dir, start_number=i)
+                    os.replace(part, slide_path)
+                    print(f"Saved Slide {i} as {slide_path.replace(os.sep, '/')}")
+            return
+        if args.durations or args.crossfade or args.split_slides:
+            print("Warning: --durations, --crossfade and --split-slides only apply with --combined")
+        # Names are reserved up front in slide order, so numbering does not depend on which encode finishes first
+        slides = []
+        for i, (source_path, image_path) in enumerate(zip(source_paths, actual_paths), 1):
             name, output_path, next_number = get_next_available_name(output_dir, start_number=i)
-            debug_print(f"Processing image {image_path} to {output_path}")
+            debug_print(f"Processing image {source_path} to {output_path}")
             if keep_original_resolution:
                 width, height = get_image_dimensions(image_path)
                 width += width % 2
                 height += height % 2
-                ffmpeg_command = (
-                    f'ffmpeg -y -loop 1 -i "{image_path}" '
-                    f'-c:v libx264 -preset fast -b:v 3500k -r 30 -pix_fmt yuv420p '
-                    f'-vf "scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2" '
-                    f'-t {duration} "{output_path}"'
-                )
             else:
-                ffmpeg_command = (
-                    f'ffmpeg -y -loop 1 -i "{image_path}" '
-                    f'-c:v libx264 -preset fast -b:v 3500k -r 30 -pix_fmt yuv420p '
-                    f'-vf "scale={target_width}:{target_height}:force_original_aspect_ratio=decrease,pad={target_width}:{target_height}:(ow-iw)/2:(oh-ih)/2" '
-                    f'-t {duration} "{output_path}"'
-                )
-            debug_print(f"FFmpeg command: {ffmpeg_command}")
-            success, output = run_command(ffmpeg_command)
-            if success and os.path.exists(output_path):
-                print(f"Saved Slide {i} as {output_path.replace(os.sep, '/')}")
-            else:
-                print(f"Failed to process image {image_path} into video")
-                debug_print(f"FFmpeg output: {output}")
-                sys.exit(1)
+                width, height = target_width, target_height
+            slides.append((i, source_path, image_path, output_path, width, height))
+        jobs = max(1, args.jobs)
+        timings = {}
+        failed = None
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = {
+                pool.submit(encode_slide, image_path, output_path, temp_dir, width, height, duration, still_fps): (i, source_path, output_path)
+                for i, source_path, image_path, output_path, width, height in slides
+            }
+            try:
+                for future in as_completed(futures):
+                    if future.cancelled():
+                        continue
+                    i, source_path, output_path = futures[future]
+                    success, output, elapsed = future.result()
+                    if success:
+                        timings[i] = (i, source_path, elapsed)
+                        print(f"Saved Slide {i} as {output_path.replace(os.sep, '/')} ({elapsed:.2f}s)")
+                    elif failed is None:
+                        failed = (source_path, output)
+                        # Slides not started yet are dropped and running encodes are stopped; futures dropped
+                        # by cancel_futures never notify as_completed, so stop waiting on them here
+                        pool.shutdown(wait=False, cancel_futures=True)
+                        terminate_active_processes()
+                        break
+            except BaseException:
+                # Ctrl-C: without this the with block would wait for every queued slide
+                pool.shutdown(wait=False, cancel_futures=True)
+                terminate_active_processes()
+                for i, source_path, image_path, output_path, width, height in slides:
+                    if i not in timings:
+                        release_name(output_path)
+                raise
+        if failed is not None:
+            for i, source_path, image_path, output_path, width, height in slides:
+                if i not in timings:
+                    release_name(output_path)
+            source_path, output = failed
+            print(f"Failed to process image {source_path} into video")
+            debug_print(f"FFmpeg output: {output}")
+            sys.exit(1)
+        report_slide_timings([timings[i] for i in sorted(timings)], time.time() - start_time, jobs)
     finally:
         if os.path.exists(temp_dir):
             shutil.rmtree(temp_dir, ignore_errors=True)
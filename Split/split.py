@@ -3,6 +3,7 @@ import sys
 import os
 import argparse
 import time
+import re
 import shutil
 
 DEBUG = False
@@ -53,14 +54,45 @@ def run_command(command, suppress_errors=False, timeout=None, retries=1):
             if process.poll() is None:
                 process.terminate()
 
+_used_numbers = {}
+
 def get_next_available_name(output_dir, prefix, extension, start_number=1):
+    # Lists output_dir once per prefix/extension, then reserves each name with an exclusive create
+    # so concurrent runs writing to the same folder never pick the same file
+    key = (os.path.abspath(output_dir), prefix, extension)
+    if key not in _used_numbers:
+        pattern = re.compile(rf"{re.escape(prefix)}_(\d+){re.escape(extension)}")
+        used = set()
+        try:
+            with os.scandir(output_dir) as it:
+                for entry in it:
+                    match = pattern.fullmatch(entry.name)
+                    if match:
+                        used.add(int(match.group(1)))
+        except FileNotFoundError:
+            pass
+        _used_numbers[key] = used
+    used = _used_numbers[key]
     number = start_number
     while True:
+        while number in used:
+            number += 1
+        used.add(number)
         name = f"{prefix}_{number}{extension}"
         full_path = os.path.join(output_dir, name)
-        if not os.path.exists(full_path):
-            return name, full_path, number + 1
-        number += 1
+        try:
+            os.close(os.open(full_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+        except FileExistsError:
+            continue
+        return name, full_path, number + 1
+
+def release_name(full_path):
+    # Remove the empty placeholder left by get_next_available_name when nothing was written
+    try:
+        if os.path.getsize(full_path) == 0:
+            os.remove(full_path)
+    except OSError:
+        pass
 
 def get_file_duration(file_path):
     command = f'ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 "{file_path}"'
@@ -136,24 +168,29 @@ def main():
         print(f"Warning: Input duration {file_duration}s is less than 5s. Using full duration.")
     video_name, video_path, next_number = get_next_available_name(output_dir, "v", ".mp4")
     audio_name, audio_path, _ = get_next_available_name(output_dir, "a", ".m4a", start_number=next_number-1)
-    ffmpeg_command = f'ffmpeg -y -i "{actual_input}" -c:v copy -an -t 5 "{video_path}"'
-    success, output = run_command(ffmpeg_command)
-    if success:
-        print(f"Saved video as {video_path.replace(os.sep, '/')}")
-        if has_audio_stream(actual_input):
-            ffmpeg_command = f'ffmpeg -y -i "{actual_input}" -vn -c:a aac -b:a 128k -t 5 "{audio_path}"'
-            success, output = run_command(ffmpeg_command)
-            if success:
-                print(f"Saved audio as {audio_path.replace(os.sep, '/')}")
+    try:
+        ffmpeg_command = f'ffmpeg -y -i "{actual_input}" -c:v copy -an -t 5 "{video_path}"'
+        success, output = run_command(ffmpeg_command)
+        if success:
+            print(f"Saved video as {video_path.replace(os.sep, '/')}")
+            if has_audio_stream(actual_input):
+                ffmpeg_command = f'ffmpeg -y -i "{actual_input}" -vn -c:a aac -b:a 128k -t 5 "{audio_path}"'
+                success, output = run_command(ffmpeg_command)
+                if success:
+                    print(f"Saved audio as {audio_path.replace(os.sep, '/')}")
+                else:
+                    print(f"Audio extraction failed for {actual_input}: {output}")
+                    os.remove(video_path)
+                    sys.exit(1)
             else:
-                print(f"Audio extraction failed for {actual_input}: {output}")
-                os.remove(video_path)
-                sys.exit(1)
+                print(f"No audio stream in {actual_input}")
         else:
-            print(f"No audio stream in {actual_input}")
-    else:
-        print(f"Split failed for {actual_input}: {output}")
-        sys.exit(1)
+            print(f"Split failed for {actual_input}: {output}")
+            sys.exit(1)
+    finally:
+        # Also reached on Ctrl-C, so empty placeholders never keep their numbers
+        release_name(video_path)
+        release_name(audio_path)
 
 if __name__ == "__main__":
     main()